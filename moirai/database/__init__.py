@@ -22,44 +22,98 @@
 
 import json
 import os
+import threading
 from pathlib import Path
 
 __printed = False
+__config = {"mtime": None, "database": None}
+__handle = {"pid": None, "key": None, "db": None}
+__lock = threading.Lock()
 
 
-def DatabaseV1():
-    global __printed
-    try:
-        config_dir = str(Path.home() / ".config")
-        xdg_config = os.environ.get("XDG_CONFIG_HOME", config_dir)
-        config_file = str(Path(xdg_config) / "moirai" / "config.json")
+def config_file_path():
+    """
+    Returns the path of moirai's config.json.
+    """
+    config_dir = str(Path.home() / ".config")
+    xdg_config = os.environ.get("XDG_CONFIG_HOME", config_dir)
+    return str(Path(xdg_config) / "moirai" / "config.json")
+
+
+def database_config():
+    """
+    Returns the "database" section of config.json. The file is only parsed
+    again when it changes. Raises if the file does not exist.
+    """
+    config_file = config_file_path()
+    mtime = os.stat(config_file).st_mtime_ns
+    if __config["mtime"] != mtime:
         with open(config_file) as f:
             cfgstr = f.read()
-            if cfgstr:
-                cfg = json.loads(cfgstr)
-                db = cfg.get("database", None)
-                if db:
-                    adapter = db.get("adapter", "mongodb")
-                    host = db.get("host", "127.0.0.1")
-                    port = db.get("port", 3306)
-                    username = db.get("username", None)
-                    password = db.get("password", None)
-                    if adapter == "mongodb":
-                        if not __printed:
-                            print("Using MongoDB")
-                            __printed = True
-                        from moirai.database.mongodb import DatabaseV1
+            cfg = json.loads(cfgstr) if cfgstr else {}
+        __config["database"] = cfg.get("database", None) or {}
+        __config["mtime"] = mtime
+    return __config["database"]
 
-                        return DatabaseV1()
-                    else:
-                        if not __printed:
-                            print("Using MySQL")
-                            __printed = True
-                        from moirai.database.mysql import DatabaseV1
 
-                        return DatabaseV1(host, port, username, password)
-    except Exception:
-        print("Falling back to MongoDB...")
+def connect(db):
+    """
+    Creates a new database instance for configuration `db`.
+    """
+    global __printed
+    adapter = db.get("adapter", "mongodb")
+    host = db.get("host", "127.0.0.1")
+    port = db.get("port", 3306)
+    username = db.get("username", None)
+    password = db.get("password", None)
+    archive_after = db.get("archive_after", None)
+    timeseries = db.get("timeseries", False)
+    write_concern = db.get("write_concern", None)
+    if adapter == "mongodb":
+        if not __printed:
+            print("Using MongoDB")
+            __printed = True
         from moirai.database.mongodb import DatabaseV1
 
-        return DatabaseV1()
+        return DatabaseV1(archive_after, timeseries, write_concern)
+    else:
+        if not __printed:
+            print("Using MySQL")
+            __printed = True
+        from moirai.database.mysql import DatabaseV1
+
+        return DatabaseV1(host, port, username, password, archive_after)
+
+
+def DatabaseV1():
+    """
+    Returns this process' database instance. It's shared by everyone in the
+    process (its client pools connections and is thread-safe), so don't close
+    it. A new one is created after a fork or when the configuration changes.
+    """
+    try:
+        db = database_config()
+    except Exception:
+        if __handle["key"] != "fallback":
+            print("Falling back to MongoDB...")
+        db = {}
+    key = json.dumps(db, sort_keys=True) if db else "fallback"
+    with __lock:
+        if __handle["pid"] != os.getpid() or __handle["key"] != key:
+            __handle["db"] = connect(db)
+            __handle["pid"] = os.getpid()
+            __handle["key"] = key
+        return __handle["db"]
+
+
+def migrate():
+    """
+    Brings the database schema up to date. Called once by the main process on
+    startup, so the instances created by DatabaseV1() don't check the schema.
+    """
+    try:
+        db = connect(database_config())
+    except FileNotFoundError:
+        db = connect({})
+    db.migrate()
+    db.close()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Cold storage for finished tests. Samples of old tests are moved out of the
+database into compressed per-test files, leaving only the `graphs` metadata
+(and the path of the archive) in the database.
+"""
+
+import functools
+import os
+import uuid
+
+import numpy as np
+
+from moirai.decorators import LOG_DIR
+
+ARCHIVE_DIR = os.path.join(os.path.dirname(LOG_DIR), "archive")
+
+
+def write_archive(date, points):
+    """
+    Writes `points` (an iterable of {sensor, time, value} dicts sorted by time)
+    to a new compressed archive and returns its path.
+    """
+    sensors = {}
+    index, times, values = [], [], []
+    for point in points:
+        index.append(sensors.setdefault(point["sensor"], len(sensors)))
+        times.append(point["time"])
+        values.append(point["value"])
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    name = "%s-%s.npz" % (date.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex)
+    path = os.path.join(ARCHIVE_DIR, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            sensors=np.array(list(sensors), dtype=str),
+            index=np.array(index, dtype=np.int32),
+            time=np.array(times, dtype=np.float64),
+            value=np.array(values, dtype=np.float64),
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+@functools.lru_cache(maxsize=8)
+def load_archive(path):
+    """
+    Loads the archive at `path`. The most recently used archives are kept in
+    memory, as the live graph polls the same test repeatedly.
+    """
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def test_data(path, skip=0):
+    """
+    Same as DatabaseV1.get_test_data, but reading from the archive.
+    """
+    archive = load_archive(path)
+    sensors = archive["sensors"].tolist()
+    index = archive["index"][skip:].tolist()
+    times = archive["time"][skip:].tolist()
+    values = archive["value"][skip:].tolist()
+    return [
+        {"sensor": sensors[i], "time": t, "value": v}
+        for i, t, v in zip(index, times, values)
+    ]
+
+
+def filtered_test_data(path, sensors):
+    """
+    Same as DatabaseV1.get_filtered_test_data, but reading from the archive.
+    """
+    archive = load_archive(path)
+    names = archive["sensors"].tolist()
+    result = []
+    for sensor in sensors:
+        if sensor not in names:
+            continue
+        mask = archive["index"] == names.index(sensor)
+        result.append(
+            {
+                "sensor": sensor,
+                "time": archive["time"][mask].tolist(),
+                "values": archive["value"][mask].tolist(),
+            }
+        )
+    return result
+
+
+def iter_test_data(path, sensors, batch_size=100000):
+    """
+    Same as DatabaseV1.iter_test_data, but reading from the archive.
+    """
+    archive = load_archive(path)
+    names = archive["sensors"]
+    mask = np.isin(archive["index"], [i for i, n in enumerate(names) if n in sensors])
+    index = archive["index"][mask]
+    times = archive["time"][mask]
+    values = archive["value"][mask]
+    for i in range(0, len(times), batch_size):
+        chunk = slice(i, i + batch_size)
+        yield names[index[chunk]], times[chunk], values[chunk]
+
+
+def remove_archive(path):
+    """
+    Deletes the archive at `path`, if it exists.
+    """
+    load_archive.cache_clear()
+    if os.path.exists(path):
+        os.remove(path)
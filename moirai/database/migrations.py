@@ -0,0 +1,44 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Versioned schema migrations. Adapters describe their schema history as a list
+of (version, step) pairs and the runner applies the missing ones, in order.
+"""
+
+
+def _parse(version):
+    return tuple(int(n) for n in str(version).split("."))
+
+
+def run_migrations(db, steps):
+    """
+    Runs the steps newer than the schema version saved in `db`, saving the
+    new version after each one, so an interrupted migration resumes from the
+    step that failed.
+    """
+    current = db.get_setting("version")
+    for version, step in steps:
+        if current is None or _parse(version) > _parse(current):
+            print("Migrating database to version %s..." % version)
+            step()
+            db.set_setting("version", version)
+            current = version
@@ -23,28 +23,77 @@
 Database class. Connects to MongoDB and abstracts all communication with it.
 """
 
+import datetime
 import time
 import uuid
 
-from pymongo import MongoClient
+from pymongo import MongoClient, WriteConcern
+
+from moirai.database import archive
+from moirai.database.migrations import run_migrations
+
+# Time-series collections need a date as timeField. Samples are indexed by the
+# seconds elapsed since the start of the test, so they are stored as an offset
+# from the epoch, besides the exact `time`.
+EPOCH = datetime.datetime(1970, 1, 1)
 
 
 class DatabaseV1(object):
     """
     Database class. Connects to MongoDB and abstracts all communication.
+
+    If `timeseries` is set and the server supports it (MongoDB 5+),
+    graphs_data is a time-series collection whose samples have the shape
+    {ts, meta: {graph, sensor}, time, value}. Otherwise it's a regular
+    collection of {graph, sensor, time, value}.
+
+    Samples are written with the write concern saved with their test, or
+    `write_concern` if the test has none (e.g. {"w": 1, "j": False}), and
+    finish_test makes them durable with a journaled write.
     """
 
-    def __init__(self):
+    def __init__(self, archive_after=None, timeseries=False, write_concern=None):
         self.client = MongoClient()
         self.db = self.client.moirai
         self.token_lifespan = 24 * 3600
-        self.__migrate()
-        self.__create_indexes()
-        self.set_setting("version", "1.0")
+        self.archive_after = archive_after
+        self.want_timeseries = timeseries
+        self.write_concern = write_concern
+        self.__collections = {}
+        self.__timeseries = None
 
     def close(self):
         self.client.close()
 
+    def migrate(self):
+        """
+        Brings the schema to the latest version and, if configured, moves
+        graphs_data to a time-series collection. Runs once, when the server
+        starts.
+        """
+        steps = [("1.0", self.__migrate), ("1.1", self.__create_indexes)]
+        run_migrations(self, steps)
+        self.__migrate_to_timeseries()
+
+    @property
+    def timeseries(self):
+        if self.__timeseries is None:
+            self.__detect_layout()
+        return self.__timeseries
+
+    @property
+    def graph(self):
+        return "meta.graph" if self.timeseries else "graph"
+
+    @property
+    def sensor(self):
+        return "meta.sensor" if self.timeseries else "sensor"
+
+    @property
+    def time(self):
+        # Time-series collections are indexed (and clustered) on ts.
+        return "ts" if self.timeseries else "time"
+
     def set_setting(self, key, value):
         db = self.db.settings
         db.replace_one({"key": key}, {"key": key, "value": value}, upsert=True)
@@ -78,94 +127,309 @@ class DatabaseV1(object):
         self.set_setting("tokens", ts)
         return t["token"]
 
-    def save_test(self, name, date):
+    def save_test(self, name, date, write_concern=None):
         graph = {"name": name, "date": date}
+        if write_concern:
+            graph["write_concern"] = write_concern
         self.db.graphs.insert_one(graph)
         return graph["_id"]
 
+    def finish_test(self, graph_id, loop_stats=None):
+        """
+        Marks the test as finished with a journaled write, which is only
+        acknowledged once every sample written before it is in the journal.
+        Stores the loop's timing summary, if given, with the graph.
+        """
+        graphs = self.db.graphs.with_options(write_concern=WriteConcern(j=True))
+        update = {"finished": datetime.datetime.utcnow()}
+        if loop_stats is not None:
+            update["loop_stats"] = loop_stats
+        graphs.update_one({"_id": graph_id}, {"$set": update})
+        self.__collections.pop(graph_id, None)
+
     def save_test_sensor_value(self, graph_id, sensor, value, time):
         if isinstance(value, bool):
             value = int(value)
         elif not isinstance(value, int):
             value = float(value)
-        data = {"sensor": sensor, "value": value, "time": time, "graph": graph_id}
-        self.db.graphs_data.insert_one(data)
+        data = self.__sample(graph_id, sensor, value, time)
+        self.__data_collection(graph_id).insert_one(data)
+
+    def save_test_sensor_values(self, values):
+        """
+        Bulk version of save_test_sensor_value. `values` is a list of
+        (graph_id, sensor, value, time) tuples.
+        """
+        graphs = {}
+        for v in values:
+            graphs.setdefault(v[0], []).append(self.__sample(*v))
+        for graph_id, data in graphs.items():
+            self.__data_collection(graph_id).insert_many(data, ordered=False)
 
     def list_test_data(self):
         cursor = self.db.graphs.find()
         tests = [{"name": t["name"], "date": t["date"]} for t in cursor]
         return tests
 
+    def get_test_loop_stats(self, test, start_time):
+        graph = self.db.graphs.find_one({"name": test, "date": start_time})
+        return graph.get("loop_stats", None) if graph else None
+
     def get_test_data(self, test, start_time, skip=0):
-        oid = self.db.graphs.find_one({"name": test, "date": start_time})["_id"]
-        cursor = self.db.graphs_data.aggregate(
-            [
-                {"$match": {"graph": oid}},
-                {"$sort": {"time": 1}},
-                {"$skip": skip},
-                {"$project": {"sensor": 1, "time": 1, "value": 1, "_id": 0}},
-            ]
-        )
+        graph = self.db.graphs.find_one({"name": test, "date": start_time})
+        if "archive" in graph:
+            return archive.test_data(graph["archive"], skip)
+        cursor = self.__points(graph["_id"], skip=skip)
         return list(cursor)
 
     def get_filtered_test_data(self, test, start_time, sensors):
-        oid = self.db.graphs.find_one({"name": test, "date": start_time})["_id"]
-        match = {"$match": {"graph": oid, "sensor": {"$in": sensors}}}
-        sort = {"$sort": {"time": 1}}
+        graph = self.db.graphs.find_one({"name": test, "date": start_time})
+        if "archive" in graph:
+            return archive.filtered_test_data(graph["archive"], sensors)
+        oid = graph["_id"]
+        match = {"$match": {self.graph: oid, self.sensor: {"$in": sensors}}}
+        sort = {"$sort": {self.time: 1}}
         group = {
             "$group": {
-                "_id": "$sensor",
+                "_id": "$" + self.sensor,
                 "values": {"$push": "$value"},
                 "time": {"$push": "$time"},
             }
         }
         project = {"$project": {"time": 1, "sensor": "$_id", "values": 1, "_id": 0}}
-        cursor = self.db.graphs_data.aggregate([match, sort, group, project])
+        query = [match, sort, group, project]
+        cursor = self.db.graphs_data.aggregate(query, allowDiskUse=True)
         return list(cursor)
 
+    def iter_test_data(self, test, start_time, sensors, batch_size=100000):
+        """
+        Streams the samples of `sensors` sorted by time, in chunks of up to
+        `batch_size` samples. Each chunk is a (sensors, times, values) tuple.
+        """
+        graph = self.db.graphs.find_one({"name": test, "date": start_time})
+        if "archive" in graph:
+            yield from archive.iter_test_data(graph["archive"], sensors, batch_size)
+            return
+        sensor = "$" + self.sensor
+        query = [
+            {"$match": {self.graph: graph["_id"], self.sensor: {"$in": sensors}}},
+            {"$sort": {self.time: 1}},
+            {"$project": {"sensor": sensor, "time": 1, "value": 1, "_id": 0}},
+        ]
+        cursor = self.db.graphs_data.aggregate(query, allowDiskUse=True)
+        with cursor:
+            chunk = ([], [], [])
+            for point in cursor:
+                chunk[0].append(point["sensor"])
+                chunk[1].append(point["time"])
+                chunk[2].append(point["value"])
+                if len(chunk[0]) == batch_size:
+                    yield chunk
+                    chunk = ([], [], [])
+            if chunk[0]:
+                yield chunk
+
     def remove_test(self, test):
         tests = test if isinstance(test, list) else [test]
         for test in tests:
-            oid = self.db.graphs.find_one(test)["_id"]
+            graph = self.db.graphs.find_one(test)
+            oid = graph["_id"]
             self.db.graphs.delete_one({"_id": oid})
-            self.db.graphs_data.delete_many({"graph": oid})
+            self.db.graphs_data.delete_many({self.graph: oid})
+            if "archive" in graph:
+                archive.remove_archive(graph["archive"])
+
+    def archive_tests(self):
+        """
+        Moves the samples of tests older than `archive_after` days to archive
+        files. The running test is never archived.
+        """
+        if self.archive_after is None:
+            return
+        age = datetime.timedelta(days=float(self.archive_after))
+        limit = datetime.datetime.utcnow() - age
+        running = self.get_setting("current_test")
+        last = self.db.graphs.find_one(sort=[("date", -1)])
+        query = {"date": {"$lt": limit}, "archive": {"$exists": False}}
+        for graph in list(self.db.graphs.find(query)):
+            if graph["_id"] == last["_id"] and graph["name"] == running:
+                continue
+            path = archive.write_archive(graph["date"], self.__points(graph["_id"]))
+            self.db.graphs.update_one(
+                {"_id": graph["_id"]}, {"$set": {"archive": path}}
+            )
+            self.db.graphs_data.delete_many({self.graph: graph["_id"]})
 
     def dump_database(self):
         graphs = list(self.db.graphs.find())
         for graph in graphs:
-            graph["data"] = []
-            for point in self.db.graphs_data.find({"graph": graph["_id"]}):
-                del point["_id"]
-                del point["graph"]
-                graph["data"].append(point)
+            path = graph.pop("archive", None)
+            if path is not None:
+                graph["data"] = archive.test_data(path)
+                del graph["_id"]
+                continue
+            graph["data"] = list(self.__points(graph["_id"]))
             del graph["_id"]
         settings = self.db.settings.find({}, {"_id": 0})
         return list(settings), list(graphs)
 
     def restore_database_v2(self, settings, graphs):
+        self.__remove_archives()
         self.db.settings.drop()
         self.db.graphs.drop()
         self.db.graphs_data.drop()
+        self.__create_data_collection()
         self.db.settings.insert_many(settings)
         for graph in graphs:
             g = {"name": graph["name"], "date": graph["date"]}
             self.db.graphs.insert_one(g)
-            for point in graph["data"]:
-                point["graph"] = g["_id"]
-            self.db.graphs_data.insert_many(graph["data"])
+            data = [
+                self.__sample(g["_id"], p["sensor"], p["value"], p["time"])
+                for p in graph["data"]
+            ]
+            if data:
+                self.db.graphs_data.insert_many(data)
         self.set_setting("version", "1.0")
+        self.migrate()
 
     def restore_database_v1(self, settings, test_sensor_values):
+        self.__remove_archives()
         self.db.settings.drop()
         self.db.graphs.drop()
         self.db.graphs_data.drop()
+        self.__detect_layout()
         self.db.settings.insert_many(settings)
         self.db.test_sensor_values.insert_many(test_sensor_values)
-        self.__migrate()
+        self.migrate()
+
+    def __remove_archives(self):
+        for graph in self.db.graphs.find({"archive": {"$exists": True}}):
+            archive.remove_archive(graph["archive"])
+
+    def __sample(self, graph_id, sensor, value, time):
+        if self.timeseries:
+            return {
+                "ts": EPOCH + datetime.timedelta(seconds=time),
+                "meta": {"graph": graph_id, "sensor": sensor},
+                "time": time,
+                "value": value,
+            }
+        return {"sensor": sensor, "value": value, "time": time, "graph": graph_id}
+
+    def __data_collection(self, graph_id):
+        """
+        Returns graphs_data with the write concern of the given test.
+        """
+        if graph_id not in self.__collections:
+            graph = self.db.graphs.find_one({"_id": graph_id}, {"write_concern": 1})
+            options = (graph or {}).get("write_concern", self.write_concern)
+            collection = self.db.graphs_data
+            if options:
+                concern = WriteConcern(**options)
+                collection = collection.with_options(write_concern=concern)
+            self.__collections[graph_id] = collection
+        return self.__collections[graph_id]
+
+    def __points(self, graph_id, skip=0):
+        """
+        Returns a cursor over the {sensor, time, value} samples of a graph,
+        sorted by time. On time-series collections, matching on the meta
+        fields filters whole buckets before they are unpacked.
+        """
+        sensor = "$" + self.sensor
+        query = [
+            {"$match": {self.graph: graph_id}},
+            {"$sort": {self.time: 1}},
+            {"$skip": skip},
+            {"$project": {"sensor": sensor, "time": 1, "value": 1, "_id": 0}},
+        ]
+        return self.db.graphs_data.aggregate(query, allowDiskUse=True)
+
+    def __detect_layout(self):
+        """
+        Checks whether graphs_data is a time-series collection. Done lazily,
+        on the first access to graphs_data.
+        """
+        info = self.db.list_collections(filter={"name": "graphs_data"})
+        info = next(info, None)
+        self.__timeseries = info is not None and info.get("type") == "timeseries"
+
+    def __supports_timeseries(self):
+        return self.client.server_info()["versionArray"][0] >= 5
+
+    def __create_data_collection(self):
+        """
+        Creates an empty graphs_data collection with the configured layout.
+        """
+        if self.want_timeseries and self.__supports_timeseries():
+            self.db.create_collection(
+                "graphs_data",
+                timeseries={
+                    "timeField": "ts",
+                    "metaField": "meta",
+                    "granularity": "seconds",
+                },
+            )
+        self.__detect_layout()
+        self.__create_indexes()
 
     def __create_indexes(self):
-        self.db.graphs_data.create_index("time", name="time")
-        self.db.graphs_data.create_index("graph", name="graph")
+        if self.timeseries:
+            self.db.graphs_data.create_index(
+                [("meta.graph", 1), ("meta.sensor", 1), ("ts", 1)], name="graph"
+            )
+        else:
+            self.db.graphs_data.create_index("time", name="time")
+            self.db.graphs_data.create_index("graph", name="graph")
+
+    def __migrate_to_timeseries(self):
+        """
+        Moves the samples of a regular graphs_data collection into a new
+        time-series one, one graph at a time. If interrupted, it resumes from
+        the graph it was copying on the next start.
+        """
+        names = self.db.list_collection_names()
+        if "graphs_data_legacy" not in names:
+            if self.timeseries or not self.want_timeseries:
+                return
+            if not self.__supports_timeseries():
+                print("MongoDB < 5.0 has no time-series collections.")
+                return
+            print("Migrating graphs_data to a time-series collection...")
+            if "graphs_data" in names:
+                self.db.graphs_data.rename("graphs_data_legacy")
+            self.db.graphs_data.drop()
+            self.__create_data_collection()
+
+        legacy = self.db.graphs_data_legacy
+        self.__detect_layout()
+        if not self.timeseries and self.want_timeseries:
+            # Interrupted before the time-series collection was created, and
+            # samples saved since then created a regular one: move them to
+            # the legacy collection too.
+            batch = []
+            for point in self.db.graphs_data.find({}, {"_id": 0}):
+                batch.append(point)
+                if len(batch) == 10000:
+                    legacy.insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                legacy.insert_many(batch, ordered=False)
+            self.db.graphs_data.drop()
+            self.__create_data_collection()
+        for graph_id in legacy.distinct("graph"):
+            self.db.graphs_data.delete_many({"meta.graph": graph_id})
+            batch = []
+            for point in legacy.find({"graph": graph_id}):
+                p = (graph_id, point["sensor"], point["value"], point["time"])
+                batch.append(self.__sample(*p))
+                if len(batch) == 10000:
+                    self.db.graphs_data.insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                self.db.graphs_data.insert_many(batch, ordered=False)
+            legacy.delete_many({"graph": graph_id})
+        legacy.drop()
 
     def __migrate(self):
         if self.get_setting("version") is None:
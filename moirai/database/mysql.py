@@ -23,12 +23,18 @@
 Database class. Connects to MySQL and abstracts all communication with it.
 """
 
+import datetime
 import json
+import threading
 import time
 import uuid
 from multiprocessing import Lock
 
 import mysql.connector
+from mysql.connector import pooling
+
+from moirai.database import archive
+from moirai.database.migrations import run_migrations
 
 
 class DatabaseV1(object):
@@ -36,7 +42,14 @@ class DatabaseV1(object):
     Database class. Connects to MySQL and abstracts all communication with it.
     """
 
-    def __init__(self, host="127.0.0.1", port=3306, username=None, password=None):
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=3306,
+        username=None,
+        password=None,
+        archive_after=None,
+    ):
         self.params = {
             "host": host,
             "port": port,
@@ -44,14 +57,28 @@ class DatabaseV1(object):
             "password": password,
             "autocommit": True,
         }
-        self.__init_db()
-        self.__migrate()
         self.token_lifespan = 24 * 3600
+        self.archive_after = archive_after
         self._mutex = Lock()
+        self.__pool = None
+        self.__pool_lock = threading.Lock()
 
     def close(self):
         pass
 
+    def migrate(self):
+        """
+        Creates the schema, if needed, and brings it to the latest version.
+        Runs once, when the server starts.
+        """
+        self.__init_db()
+        steps = [
+            ("1.0", self.__migrate),
+            ("1.1", self.__add_archive_column),
+            ("1.2", self.__add_loop_stats_column),
+        ]
+        run_migrations(self, steps)
+
     def set_setting(self, key, value):
         with self._mutex:
             cnx = self.__cnx()
@@ -95,7 +122,7 @@ class DatabaseV1(object):
         self.set_setting("tokens", ts)
         return t["token"]
 
-    def save_test(self, name, date):
+    def save_test(self, name, date, write_concern=None):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
         q = "INSERT INTO `moirai`.`graphs` (`name`, `date`) VALUES (%s, %s)"
@@ -106,6 +133,31 @@ class DatabaseV1(object):
         cnx.close()
         return rowid
 
+    def finish_test(self, graph_id, loop_stats=None):
+        """
+        Every statement is committed as it runs (autocommit), so there is
+        nothing left to make durable. Only stores the loop's timing summary.
+        """
+        if loop_stats is None:
+            return
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        q = "UPDATE `moirai`.`graphs` SET `loop_stats`=%s WHERE `id`=%s"
+        cur.execute(q, (json.dumps(loop_stats), graph_id))
+        cur.close()
+        cnx.close()
+
+    def get_test_loop_stats(self, name, date):
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        query = """SELECT `loop_stats` FROM `moirai`.`graphs`
+                    WHERE `name`=%s AND `date`=%s"""
+        cur.execute(query, (name, date))
+        r = [stats for (stats,) in cur]
+        cur.close()
+        cnx.close()
+        return json.loads(r[0]) if len(r) > 0 and r[0] else None
+
     def save_test_sensor_value(self, graph_id, sensor, value, time):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
@@ -120,6 +172,24 @@ class DatabaseV1(object):
         cur.close()
         cnx.close()
 
+    def save_test_sensor_values(self, values):
+        """
+        Bulk version of save_test_sensor_value. `values` is a list of
+        (graph_id, sensor, value, time) tuples.
+        """
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        query = """INSERT INTO `moirai`.`graphs_data`
+                        (`sensor`, `value`, `time`, `graph`)
+                        VALUES (%s, %s, %s, %s)"""
+        data = [
+            (sensor, value, time, graph_id) for graph_id, sensor, value, time in values
+        ]
+        for d in (data[i : i + 1000] for i in range(0, len(data), 1000)):
+            cur.executemany(query, d)
+        cur.close()
+        cnx.close()
+
     def list_test_data(self):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
@@ -133,6 +203,11 @@ class DatabaseV1(object):
     def get_test_data(self, name, date, skip=0):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
+        path = self.__archive_of(cur, name, date)
+        if path is not None:
+            cur.close()
+            cnx.close()
+            return archive.test_data(path, skip)
         query = """
             SELECT `sensor`, `time`, `value` FROM `moirai`.`graphs_data`
                 LEFT JOIN `moirai`.`graphs`
@@ -152,6 +227,11 @@ class DatabaseV1(object):
     def get_filtered_test_data(self, name, date, sensors):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
+        path = self.__archive_of(cur, name, date)
+        if path is not None:
+            cur.close()
+            cnx.close()
+            return archive.filtered_test_data(path, sensors)
         query = """
             SELECT `time`, `value` FROM `moirai`.`graphs_data`
                 LEFT JOIN `moirai`.`graphs`
@@ -170,26 +250,112 @@ class DatabaseV1(object):
         cnx.close()
         return result
 
+    def iter_test_data(self, name, date, sensors, batch_size=100000):
+        """
+        Streams the samples of `sensors` sorted by time, in chunks of up to
+        `batch_size` samples. Each chunk is a (sensors, times, values) tuple.
+        """
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        path = self.__archive_of(cur, name, date)
+        cur.close()
+        if path is not None:
+            cnx.close()
+            yield from archive.iter_test_data(path, sensors, batch_size)
+            return
+        cur = cnx.cursor()  # Unbuffered, rows are fetched as they are read
+        query = (
+            """
+            SELECT `sensor`, `time`, `value` FROM `moirai`.`graphs_data`
+                LEFT JOIN `moirai`.`graphs`
+                ON `graphs`.`id`=`graphs_data`.`graph`
+                WHERE `graphs`.`name`=%s AND `graphs`.`date`=%s
+                AND `graphs_data`.`sensor` IN ("""
+            + ", ".join(["%s"] * len(sensors))
+            + """)
+                ORDER BY `graphs_data`.`time`
+            """
+        )
+        try:
+            cur.execute(query, (name, date, *sensors))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield tuple(zip(*rows))
+        finally:
+            if cnx.unread_result:
+                cnx.get_rows()
+            cur.close()
+            cnx.close()
+
     def remove_test(self, test):
         tests = test if isinstance(test, list) else [test]
         tests = [(t["name"], t["date"]) for t in tests]
         cnx = self.__cnx()
         cur = cnx.cursor(True)
+        paths = [self.__archive_of(cur, name, date) for name, date in tests]
         query = "DELETE FROM `moirai`.`graphs` WHERE `name`=%s AND `date`=%s"
         cur.executemany(query, tests)
         cur.close()
         cnx.close()
+        for path in paths:
+            if path is not None:
+                archive.remove_archive(path)
+
+    def archive_tests(self):
+        """
+        Moves the samples of tests older than `archive_after` days to archive
+        files. The running test is never archived.
+        """
+        if self.archive_after is None:
+            return
+        age = datetime.timedelta(days=float(self.archive_after))
+        limit = datetime.datetime.utcnow() - age
+        running = self.get_setting("current_test")
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        cur.execute("SELECT MAX(`date`) FROM `moirai`.`graphs`")
+        last_date = list(cur)[0][0]
+        query = """SELECT `id`, `name`, `date` FROM `moirai`.`graphs`
+                    WHERE `date` < %s AND `archive` IS NULL"""
+        cur.execute(query, (limit,))
+        graphs = list(cur)
+        for oid, name, date in graphs:
+            if name == running and date == last_date:
+                continue
+            query = """SELECT `sensor`, `time`, `value` FROM `moirai`.`graphs_data`
+                        WHERE `graph`=%s ORDER BY `time`"""
+            cur.execute(query, (oid,))
+            points = (
+                {"sensor": sensor, "time": time, "value": value}
+                for sensor, time, value in cur
+            )
+            path = archive.write_archive(date, points)
+            query = "UPDATE `moirai`.`graphs` SET `archive`=%s WHERE `id`=%s"
+            cur.execute(query, (path, oid))
+            cur.execute("DELETE FROM `moirai`.`graphs_data` WHERE `graph`=%s", (oid,))
+        cur.close()
+        cnx.close()
 
     def dump_database(self):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
         cur.execute("SELECT `key`, `value` FROM `moirai`.`settings`")
         settings = [{"key": key, "value": json.loads(value)} for (key, value) in cur]
-        cur.execute("SELECT `id`, `name`, `date` FROM `moirai`.`graphs`")
-        graphs = [{"id": oid, "name": name, "date": date} for oid, name, date in cur]
+        cur.execute("SELECT `id`, `name`, `date`, `archive` FROM `moirai`.`graphs`")
+        graphs = [
+            {"id": oid, "name": name, "date": date, "archive": path}
+            for oid, name, date, path in cur
+        ]
         query = """SELECT `sensor`, `time`, `value` FROM `moirai`.`graphs_data`
                     WHERE `graph`=%s"""
         for graph in graphs:
+            path = graph.pop("archive")
+            if path is not None:
+                graph["data"] = archive.test_data(path)
+                del graph["id"]
+                continue
             cur.execute(query, (graph["id"],))
             graph["data"] = [
                 {"sensor": sensor, "time": time, "value": value}
@@ -203,6 +369,7 @@ class DatabaseV1(object):
     def restore_database_v2(self, settings, graphs):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
+        self.__remove_archives(cur)
         cur.execute("DROP DATABASE IF EXISTS `moirai`")
         self.__init_db()
         query = """
@@ -225,10 +392,12 @@ class DatabaseV1(object):
             cur.executemany(query, data)
         cur.close()
         cnx.close()
+        self.migrate()
 
     def restore_database_v1(self, settings, test_sensor_values):
         cnx = self.__cnx()
         cur = cnx.cursor(True)
+        self.__remove_archives(cur)
         cur.execute("DROP DATABASE IF EXISTS `moirai`")
         self.__init_db()
         cur.execute("USE moirai")
@@ -262,10 +431,37 @@ class DatabaseV1(object):
         cur.execute('DELETE FROM `moirai`.`settings` WHERE `key`="version"')
         cur.close()
         cnx.close()
-        self.__migrate()
+        self.migrate()
 
     def __cnx(self):
-        return mysql.connector.connect(**self.params)
+        """
+        Returns a connection from the pool, created on first use. Closing it
+        gives it back to the pool. If every pooled connection is in use, opens
+        a regular one instead of failing.
+        """
+        with self.__pool_lock:
+            if self.__pool is None:
+                self.__pool = pooling.MySQLConnectionPool(
+                    pool_name="moirai-%d" % id(self), pool_size=8, **self.params
+                )
+        try:
+            return self.__pool.get_connection()
+        except pooling.PoolError:
+            return mysql.connector.connect(**self.params)
+
+    def __archive_of(self, cur, name, date):
+        query = """SELECT `archive` FROM `moirai`.`graphs`
+                    WHERE `name`=%s AND `date`=%s"""
+        cur.execute(query, (name, date))
+        r = [path for (path,) in cur]
+        return r[0] if len(r) > 0 else None
+
+    def __remove_archives(self, cur):
+        cur.execute(
+            "SELECT `archive` FROM `moirai`.`graphs` WHERE `archive` IS NOT NULL"
+        )
+        for (path,) in list(cur):
+            archive.remove_archive(path)
 
     def __init_db(self):
         cnx = self.__cnx()
@@ -273,6 +469,8 @@ class DatabaseV1(object):
         cur.execute("SET @@local.net_read_timeout=3600;")
         cur.execute('SHOW DATABASES LIKE "moirai"')
         if len(list(cur)) > 0:
+            cur.close()
+            cnx.close()
             return
         cur.execute("CREATE SCHEMA IF NOT EXISTS `moirai` DEFAULT CHARACTER SET utf8")
         cur.execute("USE moirai")
@@ -290,6 +488,7 @@ class DatabaseV1(object):
             """CREATE TABLE IF NOT EXISTS `moirai`.`graphs`
                 (`id` INT NOT NULL AUTO_INCREMENT,
                 `name` VARCHAR(100) NOT NULL, `date` DATETIME NOT NULL,
+                `archive` VARCHAR(255) NULL, `loop_stats` TEXT NULL,
                 PRIMARY KEY (`id`),
                 UNIQUE INDEX `id_UNIQUE` (`id` ASC),
                 INDEX `date_idx` (`date` ASC),
@@ -333,6 +532,7 @@ class DatabaseV1(object):
                 """CREATE TABLE IF NOT EXISTS `moirai`.`graphs`
                        (`id` INT NOT NULL AUTO_INCREMENT,
                        `name` VARCHAR(100) NOT NULL, `date` DATETIME NOT NULL,
+                       `archive` VARCHAR(255) NULL,
                        PRIMARY KEY (`id`),
                        UNIQUE INDEX `id_UNIQUE` (`id` ASC),
                        INDEX `date_idx` (`date` ASC),
@@ -380,3 +580,27 @@ class DatabaseV1(object):
             )
         cur.close()
         cnx.close()
+
+    def __add_archive_column(self):
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        cur.execute('SHOW COLUMNS FROM `moirai`.`graphs` LIKE "archive"')
+        if len(list(cur)) == 0:
+            cur.execute(
+                """ALTER TABLE `moirai`.`graphs`
+                    ADD COLUMN `archive` VARCHAR(255) NULL"""
+            )
+        cur.close()
+        cnx.close()
+
+    def __add_loop_stats_column(self):
+        cnx = self.__cnx()
+        cur = cnx.cursor(True)
+        cur.execute('SHOW COLUMNS FROM `moirai`.`graphs` LIKE "loop_stats"')
+        if len(list(cur)) == 0:
+            cur.execute(
+                """ALTER TABLE `moirai`.`graphs`
+                    ADD COLUMN `loop_stats` TEXT NULL"""
+            )
+        cur.close()
+        cnx.close()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Write-ahead spool for test samples. Samples are appended to a local file and
+a background thread bulk-loads them into the database, so the control loops
+never wait on (or fail because of) the database.
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+
+from bson import json_util
+
+from moirai.database import DatabaseV1
+from moirai.decorators import LOG_DIR, log_msg
+
+SPOOL_DIR = os.path.join(os.path.dirname(LOG_DIR), "spool")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_offset(path):
+    try:
+        with open(path) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _write_offset(path, offset):
+    with open(path + ".tmp", "w") as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _read_lines(f, offset, end, limit):
+    """
+    Returns the whole lines of `f` between `offset` and `end`, reading at
+    most `limit` bytes.
+    """
+    f.seek(offset)
+    data = f.read(min(end - offset, limit))
+    return data[: data.rfind(b"\n") + 1].splitlines(keepends=True)
+
+
+class Spool(object):
+    """
+    Per-process spool. Every process writes to its own file, named after its
+    pid, next to a file holding how much of it is already in the database.
+    Files left behind by dead processes are replayed on start.
+    """
+
+    __instance = None
+
+    @classmethod
+    def instance(cls):
+        if not Spool.__instance or Spool.__instance.pid != os.getpid():
+            Spool.__instance = Spool(DatabaseV1())
+        return Spool.__instance
+
+    def __init__(self, db, interval=0.5, batch_size=10000, chunk_size=1000):
+        self.db = db
+        self.pid = os.getpid()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        # Samples are at most a few hundred bytes, so a batch fits in this.
+        self.batch_bytes = 256 * batch_size
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        self.path = os.path.join(SPOOL_DIR, "%d.spool" % self.pid)
+        self.offset_path = os.path.join(SPOOL_DIR, "%d.offset" % self.pid)
+        self.file = open(self.path, "ab")
+        self.reader = open(self.path, "rb")
+        self.offset = 0
+        # Lines not yet in the file. The drain thread takes them under the
+        # lock and writes them outside it, so writers never wait on the disk.
+        self.pending = []
+        self.lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+        self.failing = False
+        self.thread = threading.Thread(
+            target=self.__drain_forever, name="SpoolThread", daemon=True
+        )
+        self.thread.start()
+        # Replaying the files of dead processes may wait on the database for
+        # long, and must not keep this process's samples from the disk.
+        self.recovery = threading.Thread(
+            target=self.__recover, name="SpoolRecoveryThread", daemon=True
+        )
+        self.recovery.start()
+
+    def save_test_sensor_value(self, graph_id, sensor, value, time):
+        """
+        Same as DatabaseV1.save_test_sensor_value, but only appends the sample
+        to the spool file.
+        """
+        if isinstance(value, bool):
+            value = int(value)
+        elif not isinstance(value, int):
+            value = float(value)
+        line = json.dumps([graph_id, sensor, value, time], default=json_util.default)
+        with self.lock:
+            self.pending.append(line.encode("utf-8") + b"\n")
+
+    def flush(self, timeout=10):
+        """
+        Waits until everything spooled so far is in the database. Gives up
+        after `timeout` seconds, leaving the rest to the background thread.
+        Returns True if the spool was emptied.
+        """
+        deadline = time.time() + timeout
+        while not self.__drain():
+            if time.time() > deadline:
+                return False
+            time.sleep(self.interval)
+        return True
+
+    def __drain_forever(self):
+        retry = 0
+        while True:
+            time.sleep(self.interval)
+            if time.monotonic() < retry:
+                # Backing off from a failing database, but still to disk.
+                with self.drain_lock:
+                    self.__write_pending()
+            elif not self.__drain() and self.failing:
+                retry = time.monotonic() + min(10 * self.interval, 5)
+
+    def __write_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.file.write(b"".join(pending))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def __drain(self):
+        """
+        Writes the pending samples to the file and loads one batch of it into
+        the database. Returns True when the spool is empty.
+        """
+        with self.drain_lock:
+            self.__write_pending()
+            size = self.file.tell()
+            if size == self.offset:
+                return True
+            lines = _read_lines(self.reader, self.offset, size, self.batch_bytes)
+            lines = lines[: self.batch_size]
+            loaded = self.__load(lines)
+            self.offset += sum(len(line) for line in lines[:loaded])
+            if self.offset == size:
+                self.file.truncate(0)
+                self.offset = 0
+            if loaded:
+                _write_offset(self.offset_path, self.offset)
+            return loaded == len(lines) and self.offset == 0
+
+    def __load(self, lines):
+        """
+        Saves `lines` in chunks of consecutive samples of the same test, so
+        that a failure only retries the chunk that failed. Returns how many
+        lines, from the start, are in the database.
+        """
+        values = [json.loads(line, object_hook=json_util.object_hook) for line in lines]
+        loaded = 0
+        while loaded < len(values):
+            end = loaded + 1
+            graph_id = values[loaded][0]
+            limit = min(loaded + self.chunk_size, len(values))
+            while end < limit and values[end][0] == graph_id:
+                end += 1
+            try:
+                self.db.save_test_sensor_values([tuple(v) for v in values[loaded:end]])
+            except Exception as error:
+                if not self.failing:
+                    log_msg("Spool: could not write to the database: %s" % error)
+                    print("Spool: could not write to the database: %s" % error)
+                self.failing = True
+                return loaded
+            if self.failing:
+                log_msg("Spool: database is writable again")
+            self.failing = False
+            loaded = end
+        return loaded
+
+    def __recover(self):
+        """
+        Replays the spool files of processes that died before draining them.
+        A partially written last line (from a crash mid-write) is dropped.
+        Each file is first claimed by renaming it, so that processes starting
+        together do not replay it twice; claims of dead processes are taken
+        over, from where they were left.
+        """
+        paths = glob.glob(os.path.join(SPOOL_DIR, "*.spool"))
+        paths += glob.glob(os.path.join(SPOOL_DIR, "*.replay"))
+        for path in paths:
+            # pid.spool is owned by pid, pid.claimer.replay by the claimer.
+            pids = [int(p) for p in os.path.basename(path).split(".")[:-1]]
+            pid, owner = pids[0], pids[-1]
+            if owner == self.pid or _pid_alive(owner):
+                continue
+            claimed = os.path.join(SPOOL_DIR, "%d.%d.replay" % (pid, self.pid))
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            if len(pids) == 1:
+                offset_path = os.path.join(SPOOL_DIR, "%d.offset" % pid)
+            else:
+                offset_path = path + ".offset"
+            if os.path.exists(offset_path):
+                os.replace(offset_path, claimed + ".offset")
+            offset_path = claimed + ".offset"
+            print("Spool: replaying %s" % path)
+            with open(claimed, "rb") as f:
+                offset = _read_offset(offset_path)
+                size = os.fstat(f.fileno()).st_size
+                while True:
+                    lines = _read_lines(f, offset, size, self.batch_bytes)
+                    lines = lines[: self.batch_size]
+                    if not lines:
+                        break
+                    loaded = self.__load(lines)
+                    if loaded:
+                        offset += sum(len(line) for line in lines[:loaded])
+                        _write_offset(offset_path, offset)
+                    if loaded < len(lines):
+                        time.sleep(min(10 * self.interval, 5))
+            os.remove(claimed)
+            if os.path.exists(offset_path):
+                os.remove(offset_path)
@@ -22,11 +22,19 @@
 
 import inspect
 import os
+import queue
+import time
 
 import ahio
 from moirai.abstract_process_handler import AbstractProcessHandler
+from moirai.database import DatabaseV1
+from moirai.database.spool import Spool
 from moirai.decorators import decorate_all_methods, dont_raise
 from moirai.hardware.cmd_processor import CommandProcessor
+from moirai.hardware.configured_hardware import ConfiguredHardware
+from moirai.hardware.experiment import Experiment, Worker
+from moirai.hardware import instrumentation
+from moirai.hardware.interlock import failsafe_values
 from moirai.hardware.free import Free
 from moirai.hardware.pid import PID
 
@@ -47,12 +55,33 @@ class ProcessHandler(AbstractProcessHandler):
 
     def __init__(self, pipe):
         self.cmd_processor = CommandProcessor(self)
+        self.spool = Spool.instance()
         self.pid = PID.instance()
         self.free = Free.instance()
+        self.experiment = None
+        self.experiment_running = False
+        self.last_supervision = 0
+        # Started now, so that it has the hardware set up by the first run.
+        self.worker = Worker()
         super().__init__("Hardware", pipe)
+        # The PID and Free threads publish here; only this thread sends on
+        # the pipes.
+        self.loop_stats = queue.Queue()
+        instrumentation.publisher = self.loop_stats.put
 
     def quit(self):
-        pass
+        if self.experiment:
+            DatabaseV1().set_setting("current_test", None)
+            while self.experiment:
+                self.experiment.stop()
+                self.supervise()
+                time.sleep(0.1)
+        self.worker.quit()
+        self.pid.stop()
+        self.free.stop()
+        self.pid.join(15)
+        self.free.join(15)
+        self.spool.flush()
 
     def process_command(self, sender, cmd, args):
         """
@@ -62,8 +91,84 @@ class ProcessHandler(AbstractProcessHandler):
             self.cmd_processor.process_command(sender, cmd, args)
 
     def loop(self):
-        self.pid.run()
-        self.free.run()
+        self.supervise()
+        while True:
+            try:
+                stats = self.loop_stats.get_nowait()
+            except queue.Empty:
+                break
+            self.publish_loop_stats(stats)
+
+    def start_experiment(self, kind, experiment_id):
+        """
+        Runs a controller or system response test in the experiment worker,
+        pinned to the configuration's experimentCpus if given.
+        """
+        if self.experiment:
+            print("An experiment is already running.")
+            return
+        if not self.worker.alive():
+            self.worker.quit()
+            self.worker = Worker()
+        config = DatabaseV1().get_setting("hardware_configuration") or {}
+        cpus = config.get("experimentCpus", None)
+        self.experiment = Experiment(self.worker, kind, experiment_id, cpus)
+        self.experiment_running = False
+        self.last_supervision = 0
+
+    def supervise(self):
+        """
+        Forwards the messages of the running experiment, stops it when the
+        test is stopped and cleans up after it finishes or dies.
+        """
+        experiment = self.experiment
+        if not experiment:
+            return
+        for cmd, args in experiment.messages():
+            if cmd == "loop_stats":
+                self.publish_loop_stats(args)
+        code = experiment.exitcode()
+        if code is None:
+            now = time.monotonic()
+            if now - self.last_supervision < 1:
+                return
+            self.last_supervision = now
+            running = DatabaseV1().get_setting("current_test") is not None
+            if running:
+                self.experiment_running = True
+            elif self.experiment_running:
+                experiment.stop()
+            return
+        self.experiment = None
+        self.publish_loop_stats(None)
+        if code != 0:
+            self.experiment_died(code)
+            self.worker.quit()
+            self.worker = Worker()
+
+    def experiment_died(self, code):
+        """
+        Reports an experiment process that ended abnormally (or was killed by
+        its interlock watchdog) and puts the outputs back to their default
+        values, and the interlocked actuators to their safe values.
+        """
+        db = DatabaseV1()
+        error = "Experiment process exited with code %d" % code
+        print(error)
+        db.set_setting("test_error", error)
+        db.set_setting("current_test", None)
+        hardware = ConfiguredHardware.session()
+        values = hardware.table.off_values()
+        values.update(failsafe_values(hardware.config.get("interlocks", None) or []))
+        hardware.write_many(values)
+
+    def publish_loop_stats(self, stats):
+        """
+        Sends the timing summary of the running loop to the webapi process,
+        or None when the run is over.
+        """
+        if self.pipe_for("webapi"):
+            self.send_command("webapi", "loop_stats", stats)
 
 
 def arguments_of(func):
@@ -0,0 +1,269 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Compiles the calibrations of the hardware configuration into functions of
+the raw value, once, when the hardware is configured. A calibration has
+either a formula or a table.
+
+Formulas are Python expressions of x. Polynomials (which include the linear
+and constant cases) are evaluated with Horner's method and lookups written
+as numpy.interp(x, [...], [...]) with their tables prebuilt, both without
+going through the interpreter's compile/exec. Other expressions become a
+lambda of x, with math and numpy as globals.
+
+Tables are lists of measured raw values x and their calibrated values y,
+interpolated linearly and held constant past their ends. Output channels
+use the inverse interpolation, from y to x.
+"""
+
+import ast
+import math
+
+import numpy
+
+GLOBALS = {"math": math, "numpy": numpy}
+MAX_POWER = 8
+
+
+def compile_calibration(calibration, output=False):
+    """
+    Returns a function converting a value with `calibration`: from the raw
+    value to the calibrated one for inputs, the other way around for
+    outputs. Configuration errors are raised when the function is called.
+    """
+    if "table" not in calibration:
+        return compile_formula(calibration["formula"])
+    try:
+        table = Table(calibration["table"]["x"], calibration["table"]["y"])
+        return table.inverse if output else table
+    except (KeyError, TypeError, ValueError) as err:
+        return _raising(err)
+
+
+def calibrate_series(calibration, values):
+    """
+    Converts a whole series of raw values with `calibration`, e.g. stored
+    samples when exporting. Uses the array path of the calibration if it has
+    one (tables, polynomials, numpy expressions), and falls back to one call
+    per value.
+    """
+    f = compile_calibration(calibration)
+    values = numpy.asarray(values, dtype=float)
+    try:
+        result = numpy.asarray(f(values), dtype=float)
+        if result.shape == values.shape:
+            return result
+    except Exception:
+        pass
+    return numpy.fromiter((f(v) for v in values), dtype=float, count=len(values))
+
+
+class Table(object):
+    """
+    Piecewise-linear calibration from a measured table of raw values `x` and
+    calibrated values `y`. Calling it converts raw values, scalars or arrays,
+    with numpy.interp.
+    """
+
+    def __init__(self, x, y):
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        if x.ndim != 1 or x.shape != y.shape or len(x) < 2:
+            raise ValueError("A calibration table needs two or more (x, y) pairs")
+        order = numpy.argsort(x, kind="stable")
+        self.x = x[order]
+        self.y = y[order]
+        if (numpy.diff(self.x) == 0).any():
+            raise ValueError("Repeated x in calibration table")
+        dy = numpy.diff(self.y)
+        if (dy > 0).all():
+            self.inverse_x, self.inverse_y = self.y, self.x
+        elif (dy < 0).all():
+            self.inverse_x, self.inverse_y = self.y[::-1], self.x[::-1]
+        else:
+            self.inverse_x = self.inverse_y = None
+
+    def __call__(self, x):
+        return numpy.interp(x, self.x, self.y)
+
+    def inverse(self, y):
+        """
+        Converts calibrated values back to raw ones. Only possible if the
+        table is strictly monotonic.
+        """
+        if self.inverse_x is None:
+            raise ValueError("Calibration table is not monotonic, can't invert it")
+        return numpy.interp(y, self.inverse_x, self.inverse_y)
+
+
+def compile_formula(formula):
+    """
+    Returns a function of x that evaluates `formula`. If the formula has
+    a syntax error, the function raises it when called, as the formula
+    used to be compiled at each call.
+    """
+    try:
+        tree = ast.parse(formula.strip(), "_string_", "eval")
+    except SyntaxError:
+        return _compile_statement(formula)
+
+    coefficients = _polynomial(tree.body)
+    if coefficients is not None:
+        return _horner(coefficients)
+
+    table = _interp_table(tree.body)
+    if table is not None:
+        xp, fp = table
+        return lambda x: numpy.interp(x, xp, fp)
+
+    function = ast.parse("lambda x: 0", "_string_", "eval")
+    function.body.body = tree.body
+    return eval(compile(function, "_string_", "eval"), dict(GLOBALS))
+
+
+def _compile_statement(formula):
+    """
+    Formulas that are not expressions (e.g. with a `;`) run as the
+    statement y=formula, compiled once.
+    """
+    try:
+        code = compile("y=%s" % formula, "_string_", "exec")
+    except SyntaxError as err:
+        return _raising(err)
+
+    def f(x):
+        local = {"x": x, **GLOBALS}
+        exec(code, local, local)
+        return local["y"]
+
+    return f
+
+
+def _raising(error):
+    def f(x):
+        raise error
+
+    return f
+
+
+def _horner(coefficients):
+    """
+    Returns a function evaluating the polynomial with `coefficients`, lowest
+    degree first.
+    """
+    if len(coefficients) == 1:
+        c = coefficients[0]
+        return lambda x: c + 0 * x
+    if len(coefficients) == 2:
+        b, a = coefficients
+        return lambda x: a * x + b
+    cs = coefficients[::-1]
+
+    def f(x):
+        y = cs[0]
+        for c in cs[1:]:
+            y = y * x + c
+        return y
+
+    return f
+
+
+def _polynomial(node):
+    """
+    Returns the coefficients, lowest degree first, of the expression `node`
+    if it is a polynomial of x with numeric coefficients, None otherwise.
+    """
+    if isinstance(node, ast.Constant):
+        if type(node.value) in (int, float):
+            return [node.value]
+        return None
+    if isinstance(node, ast.Name):
+        return [0, 1] if node.id == "x" else None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        p = _polynomial(node.operand)
+        if p is None or isinstance(node.op, ast.UAdd):
+            return p
+        return [-c for c in p]
+    if not isinstance(node, ast.BinOp):
+        return None
+    a = _polynomial(node.left)
+    b = _polynomial(node.right)
+    if a is None or b is None:
+        return None
+    if isinstance(node.op, ast.Add):
+        return _trim(_add(a, b))
+    if isinstance(node.op, ast.Sub):
+        return _trim(_add(a, [-c for c in b]))
+    if isinstance(node.op, ast.Mult):
+        return _trim(_multiply(a, b))
+    if isinstance(node.op, ast.Div) and len(b) == 1 and b[0] != 0:
+        return [c / b[0] for c in a]
+    if isinstance(node.op, ast.Pow) and len(b) == 1 and type(b[0]) is int:
+        if 0 <= b[0] <= MAX_POWER:
+            p = [1]
+            for _ in range(b[0]):
+                p = _multiply(p, a)
+            return _trim(p)
+    return None
+
+
+def _add(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    return [c + (b[i] if i < len(b) else 0) for i, c in enumerate(a)]
+
+
+def _multiply(a, b):
+    p = [0] * (len(a) + len(b) - 1)
+    for i, ca in enumerate(a):
+        for j, cb in enumerate(b):
+            p[i + j] += ca * cb
+    return p
+
+
+def _trim(p):
+    while len(p) > 1 and p[-1] == 0:
+        p = p[:-1]
+    return p
+
+
+def _interp_table(node):
+    """
+    Returns (xp, fp) as arrays if `node` is numpy.interp(x, xp, fp) with
+    literal tables, None otherwise.
+    """
+    if not isinstance(node, ast.Call) or len(node.args) != 3 or node.keywords:
+        return None
+    func = node.func
+    if not isinstance(func, ast.Attribute) or func.attr != "interp":
+        return None
+    if not isinstance(func.value, ast.Name) or func.value.id != "numpy":
+        return None
+    if not isinstance(node.args[0], ast.Name) or node.args[0].id != "x":
+        return None
+    try:
+        xp = numpy.array(ast.literal_eval(node.args[1]), dtype=float)
+        fp = numpy.array(ast.literal_eval(node.args[2]), dtype=float)
+    except (ValueError, TypeError, SyntaxError):
+        return None
+    return xp, fp
@@ -21,11 +21,9 @@
 # THE SOFTWARE.
 
 from moirai.decorators import decorate_all_methods, dont_raise, log
-from moirai.hardware.controller import Controller
 from moirai.hardware.free import Free
 from moirai.hardware.model_simulation import ModelSimulation
 from moirai.hardware.pid import PID
-from moirai.hardware.system_response_tests import SystemResponseTest
 
 
 @decorate_all_methods(dont_raise)
@@ -58,12 +56,10 @@ class CommandProcessor(object):
         pass
 
     def run_test(self, test):
-        test = SystemResponseTest(test)
-        test.run()
+        self.handler.start_experiment("test", test)
 
     def run_controller(self, controller):
-        controller = Controller(controller)
-        controller.run()
+        self.handler.start_experiment("controller", controller)
 
     def run_simulation(self, arg):
         data, pipe = arg
@@ -72,9 +68,22 @@ class CommandProcessor(object):
         pipe.send(result)
 
     def run_pid(self, args):
-        self.handler.flush()
         self.pid.run(args)
 
+    def update_pid(self, args):
+        self.pid.update(args)
+
+    def stop_pid(self, _):
+        self.pid.stop()
+
     def run_free(self, args):
-        self.handler.flush()
         self.free.run(args)
+
+    def update_free(self, args):
+        self.free.update(args)
+
+    def renew_free(self, args):
+        self.free.renew(args)
+
+    def stop_free(self, _):
+        self.free.stop()
@@ -21,26 +21,92 @@
 # THE SOFTWARE.
 
 import ahio
-import math
-import numpy
+import hashlib
+import json
 import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from moirai.database import DatabaseV1
+from moirai.hardware.calibration import compile_calibration
+from moirai.hardware.port_table import ANALOG, PortTable
 
-# Port types:
-# export enum Types {
-#     Digital = 1,
-#     Analog = 2,
-#     Input = 4,
-#     Output = 8,
-#     PWM = 16
-# }
+
+class Snapshot(object):
+    """
+    Values of a set of ports, all read once per tick by
+    ConfiguredHardware.acquire, and the time.monotonic_ns they were read at.
+    Which pins to read for it is resolved on the first acquire.
+    """
+
+    __slots__ = ("ports", "values", "time", "plan")
+
+    def __init__(self, ports):
+        self.ports = tuple(dict.fromkeys(ports))
+        self.values = {}
+        self.time = None
+        self.plan = None
+
+
+class Actuators(object):
+    """
+    Output ports written together by ConfiguredHardware.actuate, with the
+    values to write in `values`, in the order of `ports`. Their pins,
+    calibrations and PWM flags are resolved on the first actuate.
+    """
+
+    __slots__ = ("ports", "values", "plan")
+
+    def __init__(self, ports):
+        self.ports = tuple(dict.fromkeys(ports))
+        self.values = [0.0] * len(self.ports)
+        self.plan = None
 
 
 class ConfiguredHardware(object):
-    def __init__(self):
+    __session = None
+    __session_key = None
+    __session_pid = None
+    __session_lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        """
+        Returns the instance shared by the runs of this process, with the
+        driver already set up, and builds it again only when the hardware
+        configuration changes. Processes forked from this one inherit its
+        configuration and open a driver of their own. Experiments run in a
+        worker process that keeps a session of its own warm.
+        """
+        config = DatabaseV1().get_setting("hardware_configuration")
+        key = json.dumps(config, sort_keys=True, default=str)
+        key = hashlib.sha1(key.encode()).hexdigest()
+        with ConfiguredHardware.__session_lock:
+            session = ConfiguredHardware.__session
+            if ConfiguredHardware.__session_key != key:
+                ConfiguredHardware.__session = None
+                ConfiguredHardware.__session_key = None
+                if session is not None:
+                    session.close()
+                session = ConfiguredHardware(config)
+                ConfiguredHardware.__session = session
+                ConfiguredHardware.__session_key = key
+            elif ConfiguredHardware.__session_pid != os.getpid():
+                session.after_fork()
+            ConfiguredHardware.__session_pid = os.getpid()
+            return session
+
+    @classmethod
+    def _reset_session_lock(cls):
+        # A thread of the parent may hold the lock at the time of a fork.
+        ConfiguredHardware.__session_lock = threading.Lock()
+
+    def __init__(self, config=None):
         self.db = DatabaseV1()
-        config = self.db.get_setting("hardware_configuration")
+        if config is None:
+            config = self.db.get_setting("hardware_configuration")
 
         if config is None:
             raise Exception("No hardware configured")
@@ -54,81 +120,266 @@ class ConfiguredHardware(object):
         except Exception:
             pass
 
-        self.driver = ahio.new_driver(config["name"])
-        if config["has_setup"]:
-            args = {a["name"]: a["value"] for a in config["setup_arguments"]}
-            self.driver.setup(**args)
-
+        self.config = config
         self.ports = config["ports"]
-        for port in config["ports"]:
-            pin = port["name"]
-            if hasattr(self.driver, "Pins"):
-                pin = self.driver.Pins(pin)
-            self.driver.map_pin(port["id"], pin)
-
-        self.inputs = [p for p in config["ports"] if p["type"] & 4]
-        ps = [p["id"] for p in self.inputs]
+        self.table = PortTable(self.ports)
+        self.driver = self.__open_driver()
+
+        # Channels by alias: (port, calibration) for inputs and
+        # (port, calibration, pwm) for outputs. Calibrations may be None.
+        ins = [p for p in self.table if p.is_input]
+        outs = [p for p in self.table if p.is_output]
+        ps = {p.id for p in ins}
+        self.input_channels = {p.alias: (p.id, None) for p in ins}
+        for c in config["calibrations"]:
+            if c["port"] in ps:
+                self.input_channels[c["alias"]] = (c["port"], compile_calibration(c))
+        ps = {p.id: p.pwm for p in outs}
+        self.output_channels = {p.alias: (p.id, None, p.pwm) for p in outs}
+        for c in config["calibrations"]:
+            if c["port"] in ps:
+                f = compile_calibration(c, True)
+                self.output_channels[c["alias"]] = (c["port"], f, ps[c["port"]])
+
+        self.__bind()
+        self.read_plans = {}
+        self.write_plans = {}
+        # The interlock thread uses the driver too.
+        self.lock = threading.RLock()
+
+        # Drivers that block on I/O (serial, network) can read pins in
+        # parallel, with readWorkers threads, if the configuration (or the
+        # driver, with a thread_safe attribute) says the driver is thread
+        # safe. Otherwise pins are read one after the other.
+        self.pool = None
+        self.workers_count = int(config.get("readWorkers", None) or 0)
+        thread_safe = getattr(self.driver, "thread_safe", False)
+        thread_safe = config.get("threadSafe", thread_safe)
+        if self.workers_count > 1 and thread_safe and self.read_pins is None:
+            self.pool = ThreadPoolExecutor(self.workers_count, "ReadWorker")
+            weakref.finalize(self, self.pool.shutdown, False)
+
+    def __bind(self):
+        """
+        Binds the channels to the methods of the current driver.
+        """
+        read = self.driver.read
+        write = self.driver.write
         self.inputs = {
-            p["alias"]: lambda id=p["id"]: self.driver.read(id) for p in self.inputs
-        }
-        cs = [c for c in config["calibrations"] if c["port"] in ps]
-        cs = {
-            c["alias"]: lambda p=c["port"], f=c["formula"]: self._read_calibrated(p, f)
-            for c in cs
+            a: (lambda p=p: read(p)) if f is None else (lambda p=p, f=f: f(read(p)))
+            for a, (p, f) in self.input_channels.items()
         }
-        self.inputs = {**self.inputs, **cs}
-
-        self.outputs = [p for p in config["ports"] if p["type"] & (8 | 16)]
-        ps = {p["id"]: p["type"] for p in self.outputs}
         self.outputs = {
-            p["alias"]: lambda x, id=p["id"], t=p["type"]: self.driver.write(
-                id, x, (t & 16) != 0
-            )
-            for p in self.outputs
-        }
-        cs = [c for c in config["calibrations"] if c["port"] in ps.keys()]
-        cs = {
-            c["alias"]: lambda x, p=c["port"], f=c["formula"], t=ps[
-                c["port"]
-            ]: self._write_calibrated(p, f, x, (t & 16) != 0)
-            for c in cs
+            a: (lambda x, p=p, pwm=pwm: write(p, x, pwm))
+            if f is None
+            else (lambda x, p=p, f=f, pwm=pwm: write(p, f(x), pwm))
+            for a, (p, f, pwm) in self.output_channels.items()
         }
-        self.outputs = {**self.outputs, **cs}
-        for p in config["ports"]:
+
+        # Drivers that can access several pins in one transaction (a PLC
+        # block, a Modbus register range) do it with these methods.
+        self.read_pins = getattr(self.driver, "read_many", None)
+        self.write_pins = getattr(self.driver, "write_many", None)
+
+    def after_fork(self):
+        """
+        Only the forking thread survives a fork: the lock may be held by a
+        thread that no longer exists, and the read workers are gone. The
+        driver's connection is shared with the parent, which may still be
+        using it, so the child opens one of its own and leaves that alone.
+        """
+        self.lock = threading.RLock()
+        self.driver = self.__open_driver()
+        self.__bind()
+        if self.pool is not None:
+            self.pool = ThreadPoolExecutor(self.workers_count, "ReadWorker")
+            weakref.finalize(self, self.pool.shutdown, False)
+
+    def close(self):
+        """
+        Releases the driver and stops the read workers, once the reads and
+        writes in progress are done.
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(False)
+            exit = getattr(self.driver, "__exit__", None)
+            if exit is not None:
+                try:
+                    exit(None, None, None)
+                except Exception as err:
+                    print(err)
+
+    def read(self, port):
+        f = self.inputs.get(port, None)
+        if f is None:
+            raise Exception(f"Port {port} not configured")
+        with self.lock:
+            return f()
+
+    def write(self, port, value):
+        f = self.outputs.get(port, None)
+        if f is None:
+            raise Exception(f"Port {port} not configured")
+        with self.lock:
+            f(value)
+
+    def read_many(self, ports, values=None):
+        """
+        Reads several ports. Each hardware pin is read once, in a single
+        transaction if the driver has read_many(pins), which returns the
+        values in the order of `pins`, or in parallel if there are read
+        workers.
+
+        @returns a dict of port: value. If `values` is given, it is filled
+        and returned instead of a new dict.
+        """
+        ports = tuple(ports)
+        plan = self.read_plans.get(ports, None)
+        if plan is None:
+            plan = self.__read_plan(ports)
+        pins, channels = plan
+        raw = self.__read_pins(pins)
+        if values is None:
+            values = {}
+        for port, i, f in channels:
+            values[port] = raw[i] if f is None else f(raw[i])
+        return values
+
+    def acquire(self, snapshot):
+        """
+        Reads the ports of `snapshot` into it, in one read, and records when
+        they were read.
+        """
+        plan = snapshot.plan
+        if plan is None or plan[0] is not self:
+            pins, channels = self.__read_plan(snapshot.ports)
+            channels = [(k, i, f) for k, (_, i, f) in enumerate(channels)]
+            plan = snapshot.plan = (self, pins, channels)
+        _, pins, channels = plan
+        snapshot.time = time.monotonic_ns()
+        raw = self.__read_pins(pins)
+        ports = snapshot.ports
+        values = snapshot.values
+        for k, i, f in channels:
+            values[ports[k]] = raw[i] if f is None else f(raw[i])
+        return snapshot
+
+    def write_many(self, values):
+        """
+        Writes a dict of port: value, in a single transaction if the driver
+        has write_many(pins, values, pwms).
+        """
+        ports = tuple(values)
+        plan = self.write_plans.get(ports, None)
+        if plan is None:
+            plan = self.__write_plan(ports)
+        self.__write_pins(plan, values.values())
+
+    def actuate(self, actuators):
+        """
+        Writes the values of `actuators`, as write_many does.
+        """
+        plan = actuators.plan
+        if plan is None or plan[0] is not self:
+            plan = actuators.plan = (self, self.__write_plan(actuators.ports))
+        self.__write_pins(plan[1], actuators.values)
+
+    def __write_pins(self, plan, values):
+        pins, calibrations, pwms = plan
+        raw = [x if f is None else f(x) for x, f in zip(values, calibrations)]
+        with self.lock:
+            if self.write_pins is not None:
+                self.write_pins(pins, raw, pwms)
+                return
+            write = self.driver.write
+            for pin, value, pwm in zip(pins, raw, pwms):
+                write(pin, value, pwm)
+
+    def __write_plan(self, ports):
+        """
+        Returns the pins, calibrations and PWM flags of `ports`. Plans are
+        cached by ports.
+        """
+        pins, calibrations, pwms = [], [], []
+        for port in ports:
+            channel = self.output_channels.get(port, None)
+            if channel is None:
+                raise Exception(f"Port {port} not configured")
+            pin, f, pwm = channel
+            pins.append(pin)
+            calibrations.append(f)
+            pwms.append(pwm)
+        if len(self.write_plans) > 64:
+            self.write_plans.clear()
+        plan = self.write_plans[ports] = (pins, calibrations, pwms)
+        return plan
+
+    def __read_pins(self, pins):
+        with self.lock:
+            if self.read_pins is not None:
+                return self.read_pins(pins)
+            if self.pool is not None and len(pins) > 1:
+                return list(self.pool.map(self.driver.read, pins))
+            read = self.driver.read
+            return [read(pin) for pin in pins]
+
+    def __read_plan(self, ports):
+        """
+        Returns the distinct pins to read for `ports` and, for each port, the
+        index of its pin and its calibration. Plans are cached by ports.
+        """
+        pins = []
+        index = {}
+        channels = []
+        for port in ports:
+            channel = self.input_channels.get(port, None)
+            if channel is None:
+                raise Exception(f"Port {port} not configured")
+            pin, f = channel
+            if pin not in index:
+                index[pin] = len(pins)
+                pins.append(pin)
+            channels.append((port, index[pin], f))
+        if len(self.read_plans) > 64:
+            self.read_plans.clear()
+        self.read_plans[ports] = (pins, channels)
+        return pins, channels
+
+    def __open_driver(self):
+        """
+        Creates and sets up an instance of the configured driver, with the
+        ports mapped and their types and directions set.
+        """
+        config = self.config
+        driver = ahio.new_driver(config["name"])
+        if config["has_setup"]:
+            args = {a["name"]: a["value"] for a in config["setup_arguments"]}
+            driver.setup(**args)
+
+        for port in self.table:
+            pin = port.name
+            if hasattr(driver, "Pins"):
+                pin = driver.Pins(pin)
+            driver.map_pin(port.id, pin)
+
+        for p in self.table:
             direction = ahio.Direction.Input
-            if p["type"] & (8 | 16):
+            if p.is_output:
                 direction = ahio.Direction.Output
             ptype = ahio.PortType.Digital
-            if p["type"] & 2:
+            if p.type & ANALOG:
                 ptype = ahio.PortType.Analog
             try:
-                self.driver.set_pin_type(p["id"], ptype)
+                driver.set_pin_type(p.id, ptype)
             except:  # noqa: E722 pylint: disable=E722
                 pass
             try:
-                self.driver.set_pin_direction(p["id"], direction)
+                driver.set_pin_direction(p.id, direction)
             except:  # noqa: E722 pylint: disable=E722
                 pass
 
-    def _read_calibrated(self, port, formula):
-        local = {"x": self.driver.read(port), "math": math, "numpy": numpy}
-        code = compile("y=%s" % formula, "_string_", "exec")
-        exec(code, local, local)
-        return local["y"]
-
-    def _write_calibrated(self, port, formula, value, pwm):
-        local = {"x": value, "math": math, "numpy": numpy}
-        exec("y=%s" % formula, local, local)
-        self.driver.write(port, local["y"], pwm)
+        return driver
 
-    def read(self, port):
-        f = self.inputs.get(port, None)
-        if f is None:
-            raise Exception(f"Port {port} not configured")
-        return f()
 
-    def write(self, port, value):
-        f = self.outputs.get(port, None)
-        if f is None:
-            raise Exception(f"Port {port} not configured")
-        f(value)
+os.register_at_fork(after_in_child=ConfiguredHardware._reset_session_lock)
@@ -21,192 +21,166 @@
 # THE SOFTWARE.
 
 import datetime
-
-import numpy as np
-import math
 import threading
-import time
 
 import sys
 import traceback
 
 from moirai.database import DatabaseV1
-from moirai.hardware.configured_hardware import ConfiguredHardware
-from moirai.hardware.timer import Timer, Finished
+from moirai.database.spool import Spool
+from moirai.hardware.configured_hardware import ConfiguredHardware, Snapshot
+from moirai.hardware.instrumentation import loop_stats
+from moirai.hardware.interlock import Interlock, InterlockEngine
+from moirai.hardware.realtime import RealTime
+from moirai.hardware.sample_log import SampleLog, logging_policies
+from moirai.hardware.timer import Finished, Timer
+from moirai.hardware.user_code import compile_function
 
 
 class Controller(object):
     def __init__(self, controller_id):
         self.db = DatabaseV1()
+        self.spool = Spool.instance()
         cs = self.db.get_setting("controllers")
         self.cs = next((c for c in cs if c["id"] == controller_id), None)
         if self.cs is None:
             raise Exception("Controller not found")
-        self.hardware = ConfiguredHardware()
+        self.hardware = ConfiguredHardware.session()
         configuration = self.db.get_setting("hardware_configuration")
-        self.locks = [self.interlock(lo) for lo in configuration["interlocks"]]
-        self.off_values = {
-            p["alias"]: float(p["defaultValue"])
-            for p in configuration["ports"]
-            if p["type"] & (8 | 16)
-        }
+        self.configuration = configuration
+        self.interlocks = InterlockEngine(
+            self.hardware, self.db, configuration, float(self.cs["tau"])
+        )
+        self.off_values = self.hardware.table.off_values()
+        self.realtime = RealTime(configuration)
         self.running = True
         self.lock = threading.Lock()
         self.after = None
 
-    def interlock(self, lock):
+    def check_interlocks(self, values):
+        """
+        Checks the interlocks against the values of a snapshot. If one acts,
+        stops the controller and returns False.
+        """
         try:
-            code = compile("y=%s" % lock["expression"], "_string_", "exec")
-        except SyntaxError as err:
+            self.interlocks.check(values)
+        except Interlock:
+            self.running = False
+            return False
+        return True
+
+    def tripped(self):
+        """
+        Called from the interlock thread when an interlock acts while the
+        control loop is not checking them, e.g. during slow user code. Stops
+        the controller and runs the after code right away.
+        """
+        self.lock.acquire()
+        try:
+            self.running = False
+            if self.after is not None:
+                inputs = self.hardware.read_many(self.cs["inputs"])
+                _, outputs, _ = self.after(inputs, {}, {}, {}, 0, 0)
+                self.hardware.write_many(outputs)
+        except Exception as err:
             error = err.__class__.__name__
             detail = err.args[0]
-            line = err.lineno
-            scope = "interlock"
-            error_string = "%s on %s:%s: %s" % (error, scope, line, detail)
+            cl, exc, tb = sys.exc_info()
+            tb = self.stringify_tb(traceback.extract_tb(tb))
+            error_string = "%s: %s\n%s" % (error, detail, tb)
             print(error_string)
             self.db.set_setting("test_error", error_string)
-            self.running = False
-            return
-
-        def f(code=code, lock=lock):
-            try:
-                value = self.hardware.read(lock["sensor"])
-                scope = {"x": value}
-                exec(code, None, scope)
-            except Exception as err:
-                error = err.__class__.__name__
-                detail = err.args[0]
-                cl, exc, tb = sys.exc_info()
-                tb = self.stringify_tb(traceback.extract_tb(tb))
-                error_string = "%s: %s\n%s" % (error, detail, tb)
-                print(error_string)
-                self.db.set_setting("test_error", error_string)
-                raise Exception("Interlock")
-            if scope["y"]:
-                self.hardware.write(lock["actuator"], lock["actuatorValue"])
-                self.db.set_setting("test_error", "Interlock")
-                raise Exception("Interlock")
-
-        return f
-
-    def lock_forever(self):
-        interval = float(self.cs["tau"])
-        while self.running:
-            time.sleep(interval)
-            self.lock.acquire()
-            try:
-                for lock in self.locks:
-                    lock()
-            except:  # noqa: E722 pylint: disable=E722
-                try:
-                    self.running = False
-                    if self.after is not None:
-                        ins = self.cs["inputs"]
-                        inputs = {s: self.hardware.read(s) for s in ins}
-                        plocals = {
-                            "inputs": inputs,
-                            "outputs": dict(),
-                            "np": np,
-                            "math": math,
-                        }
-
-                        exec(self.after, plocals, plocals)
-
-                        for actuator, value in plocals["outputs"].items():
-                            self.hardware.write(actuator, value)
-                except Exception as err:
-                    error = err.__class__.__name__
-                    detail = err.args[0]
-                    cl, exc, tb = sys.exc_info()
-                    tb = self.stringify_tb(traceback.extract_tb(tb))
-                    error_string = "%s: %s\n%s" % (error, detail, tb)
-                    print(error_string)
-                    self.db.set_setting("test_error", error_string)
-            self.lock.release()
+        self.lock.release()
 
     def run(self):
         self.db.set_setting("current_test", self.cs["name"])
         self.db.set_setting("test_error", None)
 
         after = None
+        graph_id = None
+        stats = None
+        samples = None
         self.running = True
 
         try:
             scope = "before"
-            before = compile(self.cs["before"], "before", "exec")
+            before = compile_function(self.cs["before"], "before")
             scope = "controller"
-            controller = compile(self.cs["controller"], "controller", "exec")
+            controller = compile_function(self.cs["controller"], "controller")
             scope = "after"
-            after = compile(self.cs["after"], "after", "exec")
+            after = compile_function(self.cs["after"], "after")
             self.after = after
 
-            thread = threading.Thread(target=self.lock_forever)
-            thread.start()
-            thread.isDaemon = True
-
-            inputs = {s: self.hardware.read(s) for s in self.cs["inputs"]}
-            plocals = {
-                "inputs": inputs,
-                "outputs": dict(),
-                "s": dict(),
-                "dt": float(self.cs["tau"]),
-                "np": np,
-                "math": math,
-            }
+            self.interlocks.start(self.tripped, escalate=True)
 
-            for k, v in self.off_values.items():
-                self.hardware.write(k, v)
+            interval = float(self.cs["tau"])
+            channels = list(self.cs["inputs"])
+            snapshot = Snapshot(channels + self.interlocks.sensors)
+            inputs = self.hardware.read_many(channels)
 
-            exec(before, plocals, plocals)
+            self.hardware.write_many(self.off_values)
 
-            state = plocals["s"]
+            state, outputs, log = before(inputs, {}, {}, {}, 0, interval)
 
-            for k, v in plocals["outputs"].items():
-                self.hardware.write(k, v)
+            self.hardware.write_many(outputs)
 
             run_time = int(self.cs["runTime"])
-            interval = float(self.cs["tau"])
-            t = Timer(run_time, interval)
+            t = Timer(run_time, interval, self.cs.get("overrunPolicy", Timer.SKIP))
             start_time = datetime.datetime.utcnow()
             time = 0
-            graph_id = self.db.save_test(self.cs["name"], start_time)
+            write_concern = self.cs.get("writeConcern", None)
+            graph_id = self.db.save_test(self.cs["name"], start_time, write_concern)
+            stats = loop_stats(self.db, self.cs["name"], t)
+            stats.attach("interlock_evaluation", self.interlocks.latency)
+            stats.attach("interlock_reaction", self.interlocks)
+            policies = logging_policies(self.configuration, self.cs)
+            samples = SampleLog(self.spool, graph_id, policies)
+            save = samples.save
+            acquire = self.hardware.acquire
+            write_many = self.hardware.write_many
+            values = snapshot.values
+            self.realtime.enter(t)
+            stats.realtime = self.realtime.applied
 
             while self.db.get_setting("current_test") is not None and self.running:
                 self.lock.acquire()
-                inputs = {s: self.hardware.read(s) for s in self.cs["inputs"]}
+                acquire(snapshot)
                 self.lock.release()
-
-                plocals = {
-                    "inputs": inputs,
-                    "outputs": dict(),
-                    "s": state,
-                    "log": dict(),
-                    "t": time,
-                    "dt": interval,
-                    "np": np,
-                    "math": math,
-                }
-
-                exec(controller, plocals, plocals)
-
-                plocals["log"] = {
-                    **plocals["log"],
-                    **plocals["inputs"],
-                    **plocals["outputs"],
-                }
+                for s in channels:
+                    inputs[s] = values[s]
+                time = t.elapsed_at(snapshot.time)
+                stats.mark("read")
+
+                if not self.check_interlocks(values):
+                    break
+                stats.mark("interlock")
+
+                outputs.clear()
+                log.clear()
+                state, outputs, log = controller(
+                    inputs, outputs, state, log, time, interval
+                )
+                stats.mark("controller")
 
                 self.lock.acquire()
-                for k, v in plocals["outputs"].items():
-                    self.hardware.write(k, v)
-
-                for k, v in plocals["log"].items():
-                    self.db.save_test_sensor_value(graph_id, k, v, time)
+                write_many(outputs)
+                stats.mark("write")
+
+                # Outputs take precedence over inputs, and these over log.
+                for k, v in log.items():
+                    if k not in outputs and k not in inputs:
+                        save(k, v, time)
+                for s in channels:
+                    if s not in outputs:
+                        save(s, inputs[s], time)
+                for k, v in outputs.items():
+                    save(k, v, time)
                 self.lock.release()
-
-                state = plocals["s"]
+                stats.mark("log")
 
                 t.sleep()
-                time = t.elapsed()
+                stats.mark("sleep")
+                stats.tick()
         except Finished:
             pass
         except SyntaxError as err:
@@ -225,18 +199,14 @@ class Controller(object):
             print(error_string)
             self.db.set_setting("test_error", error_string)
 
+        self.realtime.leave()
         try:
             if after is not None:
-                inputs = {s: self.hardware.read(s) for s in self.cs["inputs"]}
-                plocals = {"inputs": inputs, "outputs": dict(), "np": np, "math": math}
-
-                exec(after, plocals, plocals)
-
-                for actuator, value in plocals["outputs"].items():
-                    self.hardware.write(actuator, value)
+                inputs = self.hardware.read_many(self.cs["inputs"])
+                _, outputs, _ = after(inputs, {}, {}, {}, 0, 0)
+                self.hardware.write_many(outputs)
 
-            for k, v in self.off_values.items():
-                self.hardware.write(k, v)
+            self.hardware.write_many(self.off_values)
         except Exception as err:
             error = err.__class__.__name__
             detail = err.args[0]
@@ -246,8 +216,13 @@ class Controller(object):
             print(error_string)
             self.db.set_setting("test_error", error_string)
 
+        self.interlocks.stop()
+        if samples is not None:
+            samples.finish()
+        self.spool.flush()
+        if graph_id is not None:
+            self.db.finish_test(graph_id, stats and stats.summary())
         self.db.set_setting("current_test", None)
-        self.db.close()
         self.running = False
 
     def stringify_tb(self, tb):
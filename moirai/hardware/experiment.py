@@ -0,0 +1,202 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Runs controllers and system response tests in a worker process of their own,
+so the hardware process stays free to answer other commands while they run.
+The worker is long-lived and keeps the hardware session warm between them.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from moirai.database import DatabaseV1
+from moirai.hardware import instrumentation
+
+# The worker is spawned, not forked: the hardware process has threads (PID,
+# Free, the spool, interlocks) whose locks a fork would copy held.
+CONTEXT = multiprocessing.get_context("spawn")
+
+# How often an idle worker checks whether the hardware configuration changed.
+WARM_INTERVAL = 5
+
+
+def warm():
+    from moirai.hardware.configured_hardware import ConfiguredHardware
+
+    try:
+        ConfiguredHardware.session()
+    except Exception as err:
+        print("Experiment worker could not set up the hardware: %s" % err)
+
+
+def run(kind, experiment_id, cpus):
+    """
+    Runs one experiment, pinned to `cpus` if given.
+    """
+    affinity = None
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            affinity = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cpus)
+        except OSError as err:
+            print("Could not pin experiment to CPUs %s: %s" % (cpus, err))
+    try:
+        if kind == "test":
+            from moirai.hardware.system_response_tests import SystemResponseTest
+
+            SystemResponseTest(experiment_id).run()
+        else:
+            from moirai.hardware.controller import Controller
+
+            Controller(experiment_id).run()
+    except Exception as err:
+        error = "%s: %s\n%s" % (
+            err.__class__.__name__,
+            err,
+            "".join(traceback.format_tb(sys.exc_info()[2])),
+        )
+        print(error)
+        db = DatabaseV1()
+        db.set_setting("test_error", error)
+        db.set_setting("current_test", None)
+    if affinity is not None:
+        os.sched_setaffinity(0, affinity)
+
+
+def main(pipe):
+    """
+    Entry point of the worker process. Runs the experiments it is sent, one
+    at a time, and sets the hardware up again while idle if its
+    configuration changes.
+    """
+    instrumentation.publisher = lambda stats: pipe.send(("loop_stats", stats))
+    warm()
+    while True:
+        try:
+            if not pipe.poll(WARM_INTERVAL):
+                warm()
+                continue
+            cmd, args = pipe.recv()
+        except (EOFError, OSError):
+            break
+        if cmd == "quit":
+            break
+        if cmd == "run":
+            run(*args)
+            pipe.send(("finished", None))
+    pipe.close()
+
+
+class Worker(object):
+    """
+    Handle of the experiment worker process.
+    """
+
+    def __init__(self):
+        self.pipe, child = CONTEXT.Pipe()
+        self.process = CONTEXT.Process(
+            target=main, args=(child,), name="ExperimentWorker"
+        )
+        self.process.start()
+        child.close()
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def quit(self, timeout=5):
+        if self.alive():
+            try:
+                self.pipe.send(("quit", None))
+            except (EOFError, OSError):
+                pass
+            self.process.join(timeout)
+        if self.alive():
+            self.process.terminate()
+        self.process.join()
+        self.pipe.close()
+
+
+class Experiment(object):
+    """
+    Supervises an experiment run by a worker: forwards its messages, stops it
+    when asked and cleans up if the worker dies.
+    """
+
+    STOP_GRACE = 5
+
+    def __init__(self, worker, kind, experiment_id, cpus=None):
+        self.worker = worker
+        self.kind = kind
+        self.experiment_id = experiment_id
+        self.finished = False
+        self.stop_requested = None
+        worker.pipe.send(("run", (kind, experiment_id, cpus)))
+
+    def alive(self):
+        return not self.finished and self.worker.alive()
+
+    def messages(self):
+        """
+        @returns the messages sent by the experiment since the last call.
+        """
+        messages = []
+        try:
+            while not self.finished and self.worker.pipe.poll():
+                message = self.worker.pipe.recv()
+                if message[0] == "finished":
+                    self.finished = True
+                else:
+                    messages.append(message)
+        except (EOFError, OSError):
+            pass
+        return messages
+
+    def stop(self):
+        """
+        Asks the experiment to stop and kills the worker if it doesn't within
+        STOP_GRACE seconds. @returns True once the experiment is over.
+        """
+        if not self.alive():
+            return True
+        now = time.monotonic()
+        if self.stop_requested is None:
+            self.stop_requested = now
+        if now - self.stop_requested > self.STOP_GRACE:
+            print("Experiment did not stop, terminating it.")
+            self.worker.process.terminate()
+            self.worker.process.join(1)
+        return not self.alive()
+
+    def exitcode(self):
+        """
+        @returns 0 once the experiment finished, the exit code of the worker
+        if it died running it, or None if still running.
+        """
+        if self.finished:
+            return 0
+        if self.worker.alive():
+            return None
+        self.worker.process.join()
+        return self.worker.process.exitcode
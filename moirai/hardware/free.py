@@ -22,16 +22,28 @@
 
 import datetime
 import math
-import sys
+import threading
 import time
-import traceback
 
 from moirai.database import DatabaseV1
-from moirai.hardware.configured_hardware import ConfiguredHardware
+from moirai.database.spool import Spool
+from moirai.hardware.configured_hardware import ConfiguredHardware, Snapshot
+from moirai.hardware.instrumentation import NullLoopStats, loop_stats
+from moirai.hardware.interlock import Interlock, InterlockEngine
+from moirai.hardware.realtime import RealTime
+from moirai.hardware.sample_log import SampleLog, logging_policies
 from moirai.hardware.timer import Timer
 
 
 class Free(object):
+    """
+    Session in which the outputs are set freely and the inputs logged, run
+    in a thread of its own. It runs while its lease lasts: every request
+    renews it, for `lease` seconds (by default twice dt, and at least one).
+    Output changes are sent as deltas and only those are written, between
+    two ticks.
+    """
+
     __instance = None
 
     @classmethod
@@ -41,124 +53,203 @@ class Free(object):
         return Free.__instance
 
     def __init__(self):
-        self.last_run = time.time()
-        self.running = False
+        self.thread = None
+        # Guards thread and next, the data of a session to start once the
+        # current one has shut down.
+        self.lock = threading.Lock()
+        self.next = None
+        self.lease = 0
+        self.stopping = False
+        self.pending = None
         self.timer = Timer(math.inf, 1)
+        self.stats = NullLoopStats()
         self.hardware = None
         self.db = DatabaseV1()
+        self.spool = Spool.instance()
         self.start_time = datetime.datetime.utcnow()
-        self.locks = []
+        self.configuration = None
+        self.interlocks = None
+        self.realtime = None
+        self.snapshot = None
         self.inputs = []
-        self.outputs = []
+        self.output_values = {}
         self.graph_id = None
-
-    def is_valid(self):
-        return (time.time() - self.last_run) < max(2 * self.timer.interval, 1)
-
-    def run(self, data=None):
+        self.samples = None
+
+    def is_running(self):
+        return self.thread is not None
+
+    def renew(self, data=None):
+        """
+        Extends the lease of the running session.
+        """
+        data = data or {}
+        dt = float(data.get("dt", None) or self.timer.interval)
+        lease = float(data.get("lease", None) or max(2 * dt, 1))
+        self.lease = time.monotonic() + lease
+
+    def run(self, data):
+        """
+        Starts a session or, if one is running with the same inputs, renews
+        its lease and applies the outputs that changed.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.start(data)
+                return
+            if self.stopping or data["inputs"] != self.inputs:
+                # Started by the running thread once it has shut down.
+                self.stopping = True
+                self.next = data
+                return
+        outputs = {
+            o["alias"]: o["value"] for o in data["outputs"] if len(o["alias"]) != 0
+        }
+        # Against what was asked last, written or still pending.
+        requested = dict(self.output_values)
+        requested.update(self.pending or {})
+        changed = {k: v for k, v in outputs.items() if requested.get(k) != v}
+        self.update(dict(data, outputs=changed))
+
+    def start(self, data):
+        self.stopping = False
+        self.pending = None
+        self.inputs = data["inputs"]
+        self.output_values = {
+            o["alias"]: o["value"] for o in data["outputs"] if len(o["alias"]) != 0
+        }
+        self.renew(data)
+        self.thread = threading.Thread(target=self.loop, args=(data,), name="Free")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, data):
+        """
+        Renews the lease and queues output changes, a dict of alias: value or
+        a list of {alias, value}, to be written before the next tick.
+        """
+        self.renew(data)
+        outputs = data.get("outputs", None) or {}
+        if isinstance(outputs, list):
+            outputs = {o["alias"]: o["value"] for o in outputs if len(o["alias"])}
+        if outputs:
+            pending = dict(self.pending or {})
+            pending.update(outputs)
+            self.pending = pending
+        if data.get("dt", None):
+            self.timer.interval = float(data["dt"])
+
+    def stop(self):
+        """
+        Asks the running thread to stop, without waiting for it to shut down.
+        """
+        with self.lock:
+            self.stopping = True
+            self.next = None
+
+    def join(self, timeout=None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def finished(self):
+        """
+        Called by the thread last: starts the session queued while it shut
+        down.
+        """
+        with self.lock:
+            self.thread = None
+            data, self.next = self.next, None
+            if data is not None:
+                self.start(data)
+
+    def loop(self, data):
+        self.graph_id = None
+        self.samples = None
+        self.interlocks = None
+        self.realtime = None
+        self.stats = NullLoopStats()
         try:
-            if data:
-                self.last_run = time.time()
-                self.running = True
-                self.timer.interval = float(data["dt"])
-                self.inputs = data["inputs"]
-                self.outputs = [
-                    out for out in data["outputs"] if len(out["alias"]) != 0
-                ]
-                config = self.db.get_setting("hardware_configuration")
-                self.locks = list(map(self.interlock, config["interlocks"]))
-
-            if not self.is_valid():
-                self.running = False
-
-            if self.running:
-                if not self.hardware:
-                    self.db.set_setting("test_error", "")
-                    self.timer = Timer(math.inf, float(data["dt"]))
-                    self.start_time = datetime.datetime.utcnow()
-                    self.hardware = ConfiguredHardware()
-                    self.last_run = time.time()
-                    self.graph_id = self.db.save_test("Free", self.start_time)
-
-                    for output in self.outputs:
-                        self.db.save_test_sensor_value(
-                            self.graph_id, output["alias"], 0, 0
-                        )
-                    for input in self.inputs:
-                        self.db.save_test_sensor_value(self.graph_id, input, 0, 0)
-
-                self.timer.sleep()
-
-                for output in self.outputs:
-                    self.hardware.write(output["alias"], output["value"])
-                    self.db.save_test_sensor_value(
-                        self.graph_id,
-                        output["alias"],
-                        output["value"],
-                        self.timer.elapsed(),
-                    )
-
-                for input in self.inputs:
-                    value = self.hardware.read(input)
-                    self.db.save_test_sensor_value(
-                        self.graph_id, input, value, self.timer.elapsed()
-                    )
-
-                for lock in self.locks:
-                    lock()
-            elif self.hardware:
-                self.shutdown()
+            self.db.set_setting("test_error", "")
+            self.configuration = self.db.get_setting("hardware_configuration")
+            policy = data.get("overrunPolicy", Timer.SKIP)
+            self.timer = Timer(math.inf, float(data["dt"]), policy)
+            self.start_time = datetime.datetime.utcnow()
+            self.hardware = ConfiguredHardware.session()
+            self.graph_id = self.db.save_test(
+                "Free", self.start_time, data.get("writeConcern", None)
+            )
+            self.stats = loop_stats(self.db, "Free", self.timer)
+            self.interlocks = InterlockEngine(
+                self.hardware, self.db, self.configuration, self.timer.interval
+            )
+            self.interlocks.start()
+            self.stats.attach("interlock_evaluation", self.interlocks.latency)
+            self.stats.attach("interlock_reaction", self.interlocks)
+            self.snapshot = Snapshot(self.inputs + self.interlocks.sensors)
+            self.realtime = RealTime(self.configuration)
+            self.realtime.enter(self.timer)
+            self.stats.realtime = self.realtime.applied
+
+            defaults = {output: "change" for output in self.output_values}
+            policies = logging_policies(self.configuration, data, defaults)
+            self.samples = SampleLog(self.spool, self.graph_id, policies)
+            for output in self.output_values:
+                self.samples.save(output, 0, 0)
+            for input in self.inputs:
+                self.samples.save(input, 0, 0)
+
+            self.hardware.write_many(self.output_values)
+            while not self.stopping and time.monotonic() < self.lease:
+                self.tick()
         except Exception as e:
             print(e)
-            self.running = False
+        try:
             self.shutdown()
+        finally:
+            self.finished()
+
+    def tick(self):
+        self.timer.sleep()
+        self.stats.mark("sleep")
+        self.stats.tick()
+
+        if self.interlocks.tripped:
+            raise Interlock("Interlock")
+
+        pending, self.pending = self.pending, None
+        if pending:
+            self.hardware.write_many(pending)
+            self.output_values.update(pending)
+        self.stats.mark("write")
+
+        snapshot = self.hardware.acquire(self.snapshot)
+        values = snapshot.values
+        self.stats.mark("read")
+
+        self.interlocks.check(values)
+        self.stats.mark("interlock")
+
+        elapsed = self.timer.elapsed_at(snapshot.time)
+        save = self.samples.save
+        for output, value in self.output_values.items():
+            save(output, value, elapsed)
+        for input in self.inputs:
+            save(input, values[input], elapsed)
+        self.stats.mark("log")
 
     def shutdown(self):
         if self.hardware:
-            self.off_values = {
-                p["alias"]: float(p["defaultValue"])
-                for p in self.hardware.ports
-                if p["type"] & (8 | 16)
-            }
-            for k, v in self.off_values.items():
-                self.hardware.write(k, v)
+            self.off_values = self.hardware.table.off_values()
+            if self.interlocks is not None:
+                self.interlocks.stop()
+            if self.realtime is not None:
+                self.realtime.leave()
+            self.hardware.write_many(self.off_values)
             self.hardware = None
-
-    def interlock(self, lock):
-        try:
-            code = compile("y=%s" % lock["expression"], "_string_", "exec")
-        except SyntaxError as err:
-            error = err.__class__.__name__
-            detail = err.args[0]
-            line = err.lineno
-            error_string = "%s on %s:%s: %s" % (error, "pid", line, detail)
-            print(error_string)
-            self.db.set_setting("test_error", error_string)
-            self.running = False
-            return
-
-        def f(code=code, lock=lock):
-            try:
-                value = self.hardware.read(lock["sensor"])
-                scope = {"x": value}
-                exec(code, None, scope)
-            except Exception as err:
-                error = err.__class__.__name__
-                detail = err.args[0]
-                cl, exc, tb = sys.exc_info()
-                tb = self.stringify_tb(traceback.extract_tb(tb))
-                error_string = "%s: %s\n%s" % (error, detail, tb)
-                print(error_string)
-                self.db.set_setting("test_error", error_string)
-                raise Exception("Interlock")
-            if scope["y"]:
-                self.hardware.write(lock["actuator"], lock["actuatorValue"])
-                self.db.set_setting("test_error", "Interlock")
-                raise Exception("Interlock")
-
-        return f
-
-    def stringify_tb(self, tb):
-        msg = "Traceback:\n\t"
-        msg += "\n\t".join(["%s:%s in %s" % (t.filename, t.lineno, t.name) for t in tb])
-        return msg
+            if self.samples is not None:
+                self.samples.finish()
+            self.spool.flush()
+            if self.graph_id is not None:
+                self.db.finish_test(self.graph_id, self.stats.summary())
+        self.stats.finish()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Timing of the phases of the control loops. Each phase is timed with the
+monotonic clock into a histogram with fixed buckets, so the cost of a tick
+and the size of the summary do not grow with the length of the test.
+"""
+
+import bisect
+import time
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+# Upper bounds of the buckets, in microseconds. The last bucket is open.
+BUCKETS = [m * 10**e for e in range(1, 6) for m in (1, 2, 5)] + [1000000]
+BOUNDS = [b * 1000 for b in BUCKETS]
+
+# Called with the summary of the running loop about once a second, and with
+# None when it finishes. Set by the hardware process to forward it to the
+# webapi process.
+publisher = None
+
+
+class Histogram(object):
+    __slots__ = ("counts", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, ns):
+        self.counts[bisect.bisect_left(BOUNDS, ns)] += 1
+        self.total += ns
+        if ns > self.maximum:
+            self.maximum = ns
+
+    def summary(self):
+        """
+        Count, mean and maximum (in microseconds) and the count per bucket.
+        """
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "mean": self.total / count / 1000 if count else 0,
+            "max": self.maximum / 1000,
+            "counts": list(self.counts),
+        }
+
+
+class SharedHistogram(Histogram):
+    """
+    A Histogram in shared memory, filled by one process and read by others.
+    It must be created before the process that fills it is started.
+    """
+
+    __slots__ = ("shared_total", "shared_maximum")
+
+    def __init__(self, counts=None, total=None, maximum=None):
+        self.counts = RawArray("q", len(BUCKETS) + 1) if counts is None else counts
+        self.shared_total = RawValue("q", 0) if total is None else total
+        self.shared_maximum = RawValue("q", 0) if maximum is None else maximum
+
+    def __reduce__(self):
+        return SharedHistogram, (self.counts, self.shared_total, self.shared_maximum)
+
+    @property
+    def total(self):
+        return self.shared_total.value
+
+    @total.setter
+    def total(self, total):
+        self.shared_total.value = total
+
+    @property
+    def maximum(self):
+        return self.shared_maximum.value
+
+    @maximum.setter
+    def maximum(self, maximum):
+        self.shared_maximum.value = maximum
+
+
+class LoopStats(object):
+    """
+    Histograms of the phases of one loop. mark(phase) adds the time since the
+    previous mark to `phase`; tick(), called once per tick right after the
+    timer sleeps, adds the lateness of the timer and publishes the summary.
+    """
+
+    def __init__(self, name, timer):
+        self.name = name
+        self.timer = timer
+        self.phases = {}
+        self.lateness = Histogram()
+        self.last = time.monotonic_ns()
+        self.published = self.last
+        self.realtime = None
+
+    def mark(self, phase):
+        now = time.monotonic_ns()
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        histogram.add(now - self.last)
+        self.last = now
+
+    def attach(self, phase, histogram):
+        """
+        Reports a histogram kept elsewhere as one of the phases.
+        """
+        self.phases[phase] = histogram
+
+    def tick(self):
+        if self.timer.lateness:
+            self.lateness.add(max(self.timer.lateness[-1], 0))
+        if publisher is not None and self.last - self.published > 1000000000:
+            self.published = self.last
+            publisher(self.summary())
+
+    def finish(self):
+        if publisher is not None:
+            publisher(None)
+
+    def summary(self):
+        """
+        Returns the histograms, the buckets' upper bounds (in microseconds),
+        the number of deadlines missed and what of the real-time mode was
+        applied (None for a normal run, the baseline to compare against).
+        """
+        return {
+            "name": self.name,
+            "buckets": BUCKETS,
+            "misses": self.timer.overruns,
+            "lateness": self.lateness.summary(),
+            "phases": {k: h.summary() for k, h in self.phases.items()},
+            "realtime": self.realtime,
+        }
+
+
+class NullLoopStats(object):
+    """
+    Used when instrumentation is disabled.
+    """
+
+    realtime = None
+
+    def mark(self, phase):
+        pass
+
+    def attach(self, phase, histogram):
+        pass
+
+    def tick(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def summary(self):
+        return None
+
+
+def loop_stats(db, name, timer):
+    """
+    Returns a LoopStats for the loop `name` if the "loop_instrumentation"
+    setting is on, a NullLoopStats otherwise.
+    """
+    if db.get_setting("loop_instrumentation"):
+        return LoopStats(name, timer)
+    return NullLoopStats()
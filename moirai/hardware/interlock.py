@@ -0,0 +1,463 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Interlocks are expressions of a sensor's value, x, that when true set an
+actuator to a safe value and stop the running test. All the interlocks of
+the hardware configuration are compiled into one function that checks them,
+in order, over the values of a snapshot. They are evaluated by a watchdog
+process of their own, so that neither the GIL nor the user's code can delay
+them.
+"""
+
+import ast
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+import ahio
+import numpy
+
+from moirai.hardware.configured_hardware import Snapshot
+from moirai.hardware.instrumentation import SharedHistogram
+from moirai.hardware.timer import Timer
+
+# States of the watchdog, shared with it.
+RUNNING = 0
+TRIPPED = 1
+ACKNOWLEDGED = 2
+STOPPED = 3
+
+# What tripped, besides the index of an interlock.
+FAILED = -2  # An interlock could not be evaluated.
+STALE = -3  # No sensor values for longer than the timeout.
+
+# Types of the sensor values passed to the watchdog as doubles.
+FLOAT = 0
+INT = 1
+BOOL = 2
+LOGIC = 3
+
+# The watchdog is spawned, not forked: the process starting it has threads,
+# whose locks a fork would copy held.
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+class Interlock(Exception):
+    pass
+
+
+def compile_interlocks(interlocks):
+    """
+    Returns a function of a dict of sensor values that returns the index of
+    the first interlock whose expression is true, or -1 if none is. Raises
+    SyntaxError for the first invalid expression.
+    """
+    body = []
+    for i, lock in enumerate(interlocks):
+        expression = str(lock["expression"]).strip()
+        expression = ast.parse(expression, "interlock", "eval").body
+        assign = ast.parse("x = values[0]").body[0]
+        assign.value.slice = ast.Constant(lock["sensor"])
+        check = ast.parse("if x:\n    return %d" % i).body[0]
+        check.test = expression
+        body += [assign, check]
+    function = ast.parse("def interlocks(values):\n    return -1").body[0]
+    function.body[:0] = body
+    module = ast.Module(body=[function], type_ignores=[])
+    ast.fix_missing_locations(module)
+    scope = {"math": math, "numpy": numpy, "np": numpy}
+    exec(compile(module, "interlock", "exec"), scope)
+    return scope["interlocks"]
+
+
+def format_error(err):
+    """
+    Formats the exception being handled as the test error.
+    """
+    error = err.__class__.__name__
+    detail = err.args[0] if err.args else ""
+    tb = traceback.extract_tb(sys.exc_info()[2])
+    tb = "\n\t".join(["%s:%s in %s" % (t.filename, t.lineno, t.name) for t in tb])
+    return "%s: %s\nTraceback:\n\t%s" % (error, detail, tb)
+
+
+def failsafe_values(interlocks):
+    """
+    The safe value of every interlocked actuator, the first given for each.
+    """
+    values = {}
+    for lock in interlocks:
+        values.setdefault(lock["actuator"], float(lock["actuatorValue"]))
+    return values
+
+
+def encode(value):
+    """
+    @returns the type code of a sensor value and the value as a double.
+    """
+    if isinstance(value, ahio.LogicValue):
+        return LOGIC, float(value.value)
+    if isinstance(value, bool):
+        return BOOL, float(value)
+    if isinstance(value, int):
+        return INT, float(value)
+    return FLOAT, float(value)
+
+
+def decode(code, x):
+    """
+    Inverse of encode.
+    """
+    if code == LOGIC:
+        return ahio.LogicValue(int(x))
+    if code == BOOL:
+        return bool(x)
+    if code == INT:
+        return int(x)
+    return x
+
+
+class SharedState(object):
+    """
+    What the engine and its watchdog share: the sensor values of the last
+    snapshot with their types and time, the state of the watchdog and what
+    tripped it.
+    """
+
+    def __init__(self, channels):
+        self.values = RawArray("d", len(channels))
+        self.codes = RawArray("b", len(channels))
+        self.time = RawValue("q", 0)
+        self.lock = CONTEXT.Lock()
+        self.state = RawValue("i", RUNNING)
+        self.ready = RawValue("b", 0)
+        self.tripped_index = RawValue("i", -1)
+        self.trip_sample = RawValue("q", 0)
+        self.trip_time = RawValue("q", 0)
+        self.actuated = RawValue("q", 0)
+        self.stopped = RawValue("b", 0)
+        self.error = RawArray("c", 4096)
+        self.trip_event = CONTEXT.Event()
+        self.latency = SharedHistogram()
+
+    def read(self, channels):
+        """
+        @returns the time and the dict of the last published values.
+        """
+        with self.lock:
+            codes = self.codes
+            values = self.values
+            return self.time.value, {
+                c: decode(codes[i], values[i]) for i, c in enumerate(channels)
+            }
+
+
+def prioritize(priority, cpus):
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, AttributeError) as err:
+        print("Interlock watchdog runs without real-time priority: %s" % err)
+
+
+def watchdog(
+    interlocks, channels, period, timeout, priority, cpus, shared, parent, escalate
+):
+    """
+    Main function of the watchdog process. Evaluates the interlocks over the
+    values published by the engine every `period` and trips, as a failsafe,
+    if they are older than `timeout`. It doesn't access the hardware: the
+    engine writes the actuators when it sees the trip. If `escalate` and the
+    engine hasn't written them `timeout` after the trip, the watchdog kills
+    the engine's process, so that its supervisor puts the outputs in a safe
+    state. After a trip it sleeps until stopped.
+    """
+    prioritize(priority, cpus)
+    function = compile_interlocks(interlocks)
+    timeout_ns = int(timeout * 1e9)
+    timer = Timer(math.inf, period)
+    shared.ready.value = 1
+    while shared.state.value == RUNNING and os.getppid() == parent:
+        timer.sleep()
+        start = time.monotonic_ns()
+        sampled, values = shared.read(channels)
+        error = "Interlock"
+        if start - sampled > timeout_ns:
+            i = STALE
+            error = "Interlock: no sensor values for %.3f s" % ((start - sampled) / 1e9)
+        else:
+            try:
+                i = function(values)
+            except Exception as err:
+                i = FAILED
+                error = format_error(err)
+        shared.latency.add(time.monotonic_ns() - start)
+        if i != -1:
+            shared.error.value = error.encode()[: len(shared.error) - 1]
+            shared.tripped_index.value = i
+            shared.trip_sample.value = sampled
+            shared.trip_time.value = time.monotonic_ns()
+            if shared.state.value == RUNNING:
+                shared.state.value = TRIPPED
+            shared.trip_event.set()
+            print(error)
+            break
+    while not shared.stopped.value and os.getppid() == parent:
+        time.sleep(period)
+        if not escalate or shared.actuated.value or not shared.trip_time.value:
+            continue
+        if time.monotonic_ns() - shared.trip_time.value > timeout_ns:
+            print("Interlock: safe values not written, killing the experiment.")
+            os.kill(parent, signal.SIGKILL)
+            return
+
+
+class InterlockEngine(object):
+    """
+    Checks the interlocks of the hardware configuration. Once started, a
+    watchdog process evaluates them at the configuration's interlockRate (Hz),
+    or once per `period` if it has none, with SCHED_FIFO priority
+    interlockPriority (80 by default) where permitted and pinned to
+    interlockCpus if given.
+
+    Loops call check with the values of their snapshot each tick, which
+    publishes them to the watchdog through shared memory and raises
+    Interlock once it has tripped. While the loop doesn't publish for longer
+    than a period, a thread of the engine reads the sensors and publishes
+    them instead. If no values are published for interlockTimeout seconds
+    (ten periods, and at least one second, by default), the watchdog trips
+    as a failsafe, setting every interlocked actuator to its safe value.
+
+    The watchdog never touches the hardware: when it trips, the engine
+    writes the actuator values, from the loop or from its thread, whichever
+    sees the trip first. Both run in the loop's process, so how long that
+    takes depends on it. Engines started with `escalate`, in a supervised
+    process, bound it: if the values aren't written interlockTimeout seconds
+    after the trip, the watchdog kills the process and the supervisor writes
+    them. The time of each check goes into the `latency` histogram, and
+    summary() reports the timings. Until the watchdog is up, or if it dies,
+    check evaluates the interlocks itself.
+    """
+
+    def __init__(self, hardware, db, configuration, period):
+        self.hardware = hardware
+        self.db = db
+        self.interlocks = configuration.get("interlocks", None) or []
+        self.sensors = [lock["sensor"] for lock in self.interlocks]
+        self.channels = list(dict.fromkeys(self.sensors))
+        rate = configuration.get("interlockRate", None)
+        self.period = 1 / float(rate) if rate else period
+        self.period_ns = int(self.period * 1e9)
+        timeout = configuration.get("interlockTimeout", None)
+        self.timeout = float(timeout) if timeout else max(10 * self.period, 1)
+        self.priority = int(configuration.get("interlockPriority", 80))
+        self.cpus = configuration.get("interlockCpus", None)
+        self.shared = SharedState(self.channels)
+        self.latency = self.shared.latency
+        self.reaction = 0
+        self.actuation = 0
+        self.escalate = False
+        self.acknowledge_lock = threading.Lock()
+        self.local_trip = False
+        self.process = None
+        self.on_trip = None
+        self.error = None
+        try:
+            self.function = compile_interlocks(self.interlocks)
+        except SyntaxError as err:
+            error = err.__class__.__name__
+            detail = err.args[0]
+            line = err.lineno
+            error_string = "%s on %s:%s: %s" % (error, "interlock", line, detail)
+            print(error_string)
+            self.error = error_string
+            self.function = None
+
+    @property
+    def tripped(self):
+        return self.local_trip or self.shared.state.value in (TRIPPED, ACKNOWLEDGED)
+
+    def check(self, values):
+        """
+        Checks the interlocks over `values`. If one acts, raises Interlock.
+        An interlock that can't be evaluated (or compiled) raises Interlock
+        too.
+        """
+        if self.function is None:
+            self.local_trip = True
+            self.db.set_setting("test_error", self.error)
+            raise Interlock("Interlock")
+        if self.process is not None:
+            if self.shared.state.value in (TRIPPED, ACKNOWLEDGED):
+                self.acknowledge()
+                raise Interlock("Interlock")
+            self.publish(values)
+            if self.shared.ready.value and self.process.is_alive():
+                return
+        # Until the watchdog is up, or if it died, check them here, over the
+        # same values the watchdog would see.
+        values = {c: decode(*encode(values[c])) for c in self.channels}
+        start = time.monotonic_ns()
+        try:
+            i = self.function(values)
+        except Exception as err:
+            self.local_trip = True
+            error_string = format_error(err)
+            print(error_string)
+            self.db.set_setting("test_error", error_string)
+            raise Interlock("Interlock")
+        finally:
+            self.latency.add(time.monotonic_ns() - start)
+        if i >= 0:
+            self.local_trip = True
+            self.hardware.write_many(self.safe_values(i))
+            self.db.set_setting("test_error", "Interlock")
+            raise Interlock("Interlock")
+
+    def publish(self, values):
+        """
+        Hands the sensor values of a snapshot over to the watchdog.
+        """
+        encoded = [encode(values[channel]) for channel in self.channels]
+        shared = self.shared
+        now = time.monotonic_ns()
+        with shared.lock:
+            for i, (code, x) in enumerate(encoded):
+                shared.codes[i] = code
+                shared.values[i] = x
+            shared.time.value = now
+
+    def acknowledge(self):
+        """
+        Marks the trip as seen, writes the safe actuator values and reports
+        the error. @returns False if it was already acknowledged.
+        """
+        shared = self.shared
+        with self.acknowledge_lock:
+            if shared.state.value != TRIPPED:
+                return False
+            shared.state.value = ACKNOWLEDGED
+        self.hardware.write_many(self.safe_values(shared.tripped_index.value))
+        now = time.monotonic_ns()
+        shared.actuated.value = now
+        self.reaction = now - shared.trip_sample.value
+        self.actuation = now - shared.trip_time.value
+        self.db.set_setting("test_error", shared.error.value.decode())
+        return True
+
+    def safe_values(self, i):
+        """
+        The safe actuator values of interlock `i`, of every interlock for a
+        failsafe trip, or none if `i` is FAILED.
+        """
+        if i == FAILED:
+            return {}
+        return failsafe_values(self.interlocks if i == STALE else [self.interlocks[i]])
+
+    def start(self, on_trip=None, escalate=False):
+        """
+        Starts the watchdog. `on_trip` is called from a thread of this process
+        if an interlock acts. With `escalate`, the watchdog kills this process
+        if the safe values aren't written in time after a trip; only for
+        processes whose supervisor then puts the outputs in a safe state.
+        """
+        if not self.interlocks or self.function is None:
+            return
+        self.on_trip = on_trip
+        self.escalate = escalate
+        self.shared.state.value = RUNNING
+        self.shared.ready.value = 0
+        self.shared.stopped.value = 0
+        self.process = CONTEXT.Process(
+            target=watchdog,
+            args=(
+                self.interlocks,
+                self.channels,
+                self.period,
+                self.timeout,
+                self.priority,
+                self.cpus,
+                self.shared,
+                os.getpid(),
+                escalate,
+            ),
+            name="InterlockWatchdog",
+            daemon=True,
+        )
+        self.process.start()
+        self.shared.time.value = time.monotonic_ns()
+        thread = threading.Thread(target=self.__run, name="InterlockThread")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.shared.state.value == RUNNING:
+            self.shared.state.value = STOPPED
+        self.shared.stopped.value = 1
+        self.shared.trip_event.set()
+        self.process.join(max(2 * self.period, 1))
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def summary(self):
+        """
+        In microseconds: the bound on the time to detect a trip; the bound on
+        the time to the actuator write, which only exists with escalation;
+        and, measured on a trip (None if there was none), the time from
+        detection and from the tripping sample to the actuator write.
+        """
+        detection = 2 * self.period * 1e6 + self.latency.maximum / 1000
+        return {
+            "period": self.period * 1e6,
+            "detection": detection,
+            "bound": detection + self.timeout * 1e6 if self.escalate else None,
+            "actuation": self.actuation / 1000 if self.actuation else None,
+            "reaction": self.reaction / 1000 if self.reaction else None,
+        }
+
+    def __run(self):
+        """
+        Publishes fresh sensor values while the loop doesn't, until the
+        watchdog trips or stops.
+        """
+        shared = self.shared
+        snapshot = Snapshot(self.channels)
+        while not shared.trip_event.wait(self.period):
+            if time.monotonic_ns() - shared.time.value <= self.period_ns:
+                continue
+            try:
+                self.publish(self.hardware.acquire(snapshot).values)
+            except Exception as err:
+                print(err)
+        if self.acknowledge() and self.on_trip is not None:
+            self.on_trip()
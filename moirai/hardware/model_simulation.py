@@ -26,6 +26,7 @@ import json
 import numpy as np
 import scipy.signal
 from moirai.database import DatabaseV1
+from moirai.database.spool import Spool
 
 
 class ModelSimulation(object):
@@ -97,6 +98,7 @@ class ModelSimulation(object):
                     outputs["x%d" % (i + 1)] = []
 
             db = DatabaseV1()
+            spool = Spool.instance()
             start_time = datetime.datetime.utcnow()
             graph_id = db.save_test("Simulation", start_time)
 
@@ -105,13 +107,13 @@ class ModelSimulation(object):
                 y = C @ x + D * self.U[k]
                 t = k * dt
 
-                db.save_test_sensor_value(graph_id, "u", float(self.U[k]), t)
+                spool.save_test_sensor_value(graph_id, "u", float(self.U[k]), t)
 
                 if not tf:
                     for i in range(len(x.flatten())):
                         k = i + 1
                         outputs["x%d" % k].append(x.flatten()[i].item())
-                        db.save_test_sensor_value(
+                        spool.save_test_sensor_value(
                             graph_id, "x%d" % k, float(x.flatten()[i].item()), t
                         )
 
@@ -119,12 +121,12 @@ class ModelSimulation(object):
                     for i in range(C.shape[0]):
                         k = i + 1
                         outputs["y%d" % k].append(y.flatten()[i].item())
-                        db.save_test_sensor_value(
+                        spool.save_test_sensor_value(
                             graph_id, "y%d" % k, float(y.flatten()[i].item()), t
                         )
                 else:
                     outputs["y"].append(y.item())
-                    db.save_test_sensor_value(graph_id, "y", float(y.item()), t)
+                    spool.save_test_sensor_value(graph_id, "y", float(y.item()), t)
 
             outputs["t"] = [dt * k for k in outputs["t"]]
 
@@ -22,18 +22,36 @@
 
 import datetime
 import math
-import sys
+import threading
 import time
-import traceback
 
 from moirai.database import DatabaseV1
-from moirai.hardware.configured_hardware import ConfiguredHardware
+from moirai.database.spool import Spool
+from moirai.hardware.configured_hardware import (
+    Actuators,
+    ConfiguredHardware,
+    Snapshot,
+)
+from moirai.hardware.instrumentation import NullLoopStats, loop_stats
+from moirai.hardware.interlock import Interlock, InterlockEngine
+from moirai.hardware.realtime import RealTime
+from moirai.hardware.sample_log import SampleLog, logging_policies
 from moirai.hardware.timer import Timer
 
 
 class PID(object):
+    """
+    PID controller running in a thread of its own. It runs while its lease
+    lasts: every request renews it, for `lease` seconds (by default twice
+    dt, and at least one). Setpoint, gains, limits and dt of a running
+    controller are updated between two ticks, all at once.
+    """
+
     __instance = None
 
+    # Parameters that can change without restarting the controller.
+    TUNABLE = ("Kp", "Ki", "Kd", "r", "umin", "umax", "dt")
+
     @classmethod
     def instance(cls):
         if not PID.__instance:
@@ -41,12 +59,21 @@ class PID(object):
         return PID.__instance
 
     def __init__(self):
-        self.last_run = time.time()
-        self.running = False
+        self.thread = None
+        # Guards thread and next, the data of a run to start once the
+        # current one has shut down.
+        self.lock = threading.Lock()
+        self.next = None
+        self.lease = 0
+        self.stopping = False
+        self.pending = None
+        self.pending_fixed = None
         self.timer = Timer(math.inf, 1)
+        self.stats = NullLoopStats()
         self.Kp = 0
         self.Ki = 0
         self.Kd = 0
+        self.r = 0
         self.y = ""
         self.u = ""
         self.le = 0
@@ -56,124 +83,214 @@ class PID(object):
         self.fixedOutputs = []
         self.hardware = None
         self.db = DatabaseV1()
+        self.spool = Spool.instance()
         self.start_time = datetime.datetime.utcnow()
-        self.locks = []
+        self.configuration = None
+        self.interlocks = None
+        self.realtime = None
+        self.snapshot = None
+        self.actuators = None
         self.graph_id = None
+        self.samples = None
+
+    def is_running(self):
+        return self.thread is not None
+
+    def renew(self, data):
+        """
+        Extends the lease of the running controller.
+        """
+        dt = float(data.get("dt", None) or self.timer.interval)
+        lease = float(data.get("lease", None) or max(2 * dt, 1))
+        self.lease = time.monotonic() + lease
 
-    def is_valid(self):
-        return (time.time() - self.last_run) < max(2 * self.timer.interval, 1)
+    def run(self, data):
+        """
+        Starts the controller or, if it's running with the same ports,
+        renews its lease and updates its parameters.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.start(data)
+                return
+            if self.stopping or data["y"] != self.y or data["u"] != self.u:
+                # Started by the running thread once it has shut down.
+                self.stopping = True
+                self.next = data
+                return
+        self.update(data)
+        fixed = [o for o in data.get("fixedOutputs", []) if len(o["alias"]) != 0]
+        if fixed != self.fixedOutputs:
+            self.fixedOutputs = fixed
+            self.pending_fixed = fixed
+
+    def start(self, data):
+        self.stopping = False
+        self.pending = None
+        self.pending_fixed = None
+        self.y = data["y"]
+        self.u = data["u"]
+        fixed = data.get("fixedOutputs", [])
+        self.fixedOutputs = [o for o in fixed if len(o["alias"]) != 0]
+        self.apply(data)
+        self.le = 0
+        self.se = 0
+        self.renew(data)
+        self.thread = threading.Thread(target=self.loop, args=(data,), name="PID")
+        self.thread.daemon = True
+        self.thread.start()
 
-    def run(self, data=None):
+    def update(self, data):
+        """
+        Queues new parameters for the running controller, to be applied
+        before its next tick, and renews its lease.
+        """
+        self.renew(data)
+        changes = {k: data[k] for k in PID.TUNABLE if data.get(k, None) is not None}
+        if changes:
+            pending = dict(self.pending or {})
+            pending.update(changes)
+            self.pending = pending
+
+    def stop(self):
+        """
+        Asks the running thread to stop, without waiting for it to shut down.
+        """
+        with self.lock:
+            self.stopping = True
+            self.next = None
+
+    def join(self, timeout=None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def finished(self):
+        """
+        Called by the thread last: starts the run queued while it shut down.
+        """
+        with self.lock:
+            self.thread = None
+            data, self.next = self.next, None
+            if data is not None:
+                self.start(data)
+
+    def apply(self, data):
+        if "Kp" in data:
+            self.Kp = float(data["Kp"])
+        if "Ki" in data:
+            self.Ki = float(data["Ki"])
+        if "Kd" in data:
+            self.Kd = float(data["Kd"])
+        if "r" in data:
+            self.r = float(data["r"])
+        if "umin" in data:
+            self.li = float(data["umin"])
+        if "umax" in data:
+            self.ls = float(data["umax"])
+        if "dt" in data:
+            self.timer.interval = float(data["dt"])
+
+    def loop(self, data):
+        self.graph_id = None
+        self.samples = None
+        self.interlocks = None
+        self.realtime = None
+        self.stats = NullLoopStats()
         try:
-            if data:
-                self.last_run = time.time()
-                self.running = True
-                self.timer.interval = float(data["dt"])
-                self.Kp = float(data["Kp"])
-                self.Ki = float(data["Ki"])
-                self.Kd = float(data["Kd"])
-                self.r = float(data["r"])
-                self.li = float(data["umin"])
-                self.ls = float(data["umax"])
-                self.y = data["y"]
-                self.u = data["u"]
-                self.fixedOutputs = [
-                    o for o in data["fixedOutputs"] if len(o["alias"]) != 0
-                ]
-                config = self.db.get_setting("hardware_configuration")
-                self.locks = list(map(self.interlock, config["interlocks"]))
-
-            if not self.is_valid():
-                self.running = False
-
-            if self.running:
-                if not self.hardware:
-                    self.db.set_setting("test_error", "")
-                    self.timer = Timer(math.inf, float(data["dt"]))
-                    self.start_time = datetime.datetime.utcnow()
-                    self.hardware = ConfiguredHardware()
-                    self.last_run = time.time()
-                    self.graph_id = self.db.save_test("PID", self.start_time)
-
-                    for output in self.fixedOutputs:
-                        self.hardware.write(output["alias"], output["value"])
-
-                    save = self.db.save_test_sensor_value
-                    save(self.graph_id, self.y, 0, 0)
-                    save(self.graph_id, self.u, 0, 0)
-                    save(self.graph_id, "R", self.r, 0)
-
-                self.timer.sleep()
-
-                y = self.hardware.read(self.y)
-                e = self.r - y
-                de = e - self.le
-                self.se += e
-                u = self.Kp * e + self.Kd * de + self.Ki * self.se
-                u = sorted([self.li, self.ls, u])[1]
-                self.hardware.write(self.u, u)
-                self.le = e
-
-                save = self.db.save_test_sensor_value
-                save(self.graph_id, self.y, y, self.timer.elapsed())
-                save(self.graph_id, self.u, u, self.timer.elapsed())
-                save(self.graph_id, "R", self.r, self.timer.elapsed())
-
-                for lock in self.locks:
-                    lock()
-            elif self.hardware:
-                self.shutdown()
+            self.db.set_setting("test_error", "")
+            self.configuration = self.db.get_setting("hardware_configuration")
+            policy = data.get("overrunPolicy", Timer.SKIP)
+            self.timer = Timer(math.inf, float(data["dt"]), policy)
+            self.start_time = datetime.datetime.utcnow()
+            self.hardware = ConfiguredHardware.session()
+            self.graph_id = self.db.save_test(
+                "PID", self.start_time, data.get("writeConcern", None)
+            )
+            self.stats = loop_stats(self.db, "PID", self.timer)
+            self.interlocks = InterlockEngine(
+                self.hardware, self.db, self.configuration, self.timer.interval
+            )
+            self.interlocks.start()
+            self.stats.attach("interlock_evaluation", self.interlocks.latency)
+            self.stats.attach("interlock_reaction", self.interlocks)
+            self.snapshot = Snapshot([self.y] + self.interlocks.sensors)
+            self.actuators = Actuators([self.u])
+            self.realtime = RealTime(self.configuration)
+            self.realtime.enter(self.timer)
+            self.stats.realtime = self.realtime.applied
+
+            fixed = {o["alias"]: o["value"] for o in self.fixedOutputs}
+            self.hardware.write_many(fixed)
+
+            policies = logging_policies(self.configuration, data, {"R": "change"})
+            self.samples = SampleLog(self.spool, self.graph_id, policies)
+            save = self.samples.save
+            save(self.y, 0, 0)
+            save(self.u, 0, 0)
+            save("R", self.r, 0)
+
+            while not self.stopping and time.monotonic() < self.lease:
+                self.tick()
         except Exception as e:
             print(e)
-            self.running = False
+        try:
             self.shutdown()
+        finally:
+            self.finished()
+
+    def tick(self):
+        self.timer.sleep()
+        self.stats.mark("sleep")
+        self.stats.tick()
+
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            self.apply(pending)
+        fixed, self.pending_fixed = self.pending_fixed, None
+        if fixed is not None:
+            self.hardware.write_many({o["alias"]: o["value"] for o in fixed})
+
+        if self.interlocks.tripped:
+            raise Interlock("Interlock")
+
+        snapshot = self.hardware.acquire(self.snapshot)
+        y = snapshot.values[self.y]
+        self.stats.mark("read")
+
+        self.interlocks.check(snapshot.values)
+        self.stats.mark("interlock")
+
+        e = self.r - y
+        de = e - self.le
+        self.se += e
+        u = self.Kp * e + self.Kd * de + self.Ki * self.se
+        u = sorted([self.li, self.ls, u])[1]
+        self.stats.mark("controller")
+        self.actuators.values[0] = u
+        self.hardware.actuate(self.actuators)
+        self.stats.mark("write")
+        self.le = e
+
+        elapsed = self.timer.elapsed_at(snapshot.time)
+        save = self.samples.save
+        save(self.y, y, elapsed)
+        save(self.u, u, elapsed)
+        save("R", self.r, elapsed)
+        self.stats.mark("log")
 
     def shutdown(self):
         if self.hardware:
-            self.off_values = {
-                p["alias"]: float(p["defaultValue"])
-                for p in self.hardware.ports
-                if p["type"] & (8 | 16)
-            }
-            for k, v in self.off_values.items():
-                self.hardware.write(k, v)
+            self.off_values = self.hardware.table.off_values()
+            if self.interlocks is not None:
+                self.interlocks.stop()
+            if self.realtime is not None:
+                self.realtime.leave()
+            self.hardware.write_many(self.off_values)
             self.hardware = None
-
-    def interlock(self, lock):
-        try:
-            code = compile("y=%s" % lock["expression"], "_string_", "exec")
-        except SyntaxError as err:
-            error = err.__class__.__name__
-            detail = err.args[0]
-            line = err.lineno
-            error_string = "%s on %s:%s: %s" % (error, "pid", line, detail)
-            print(error_string)
-            self.db.set_setting("test_error", error_string)
-            self.running = False
-            return
-
-        def f(code=code, lock=lock):
-            try:
-                value = self.hardware.read(lock["sensor"])
-                scope = {"x": value}
-                exec(code, None, scope)
-            except Exception as err:
-                error = err.__class__.__name__
-                detail = err.args[0]
-                cl, exc, tb = sys.exc_info()
-                tb = self.stringify_tb(traceback.extract_tb(tb))
-                error_string = "%s: %s\n%s" % (error, detail, tb)
-                print(error_string)
-                self.db.set_setting("test_error", error_string)
-                raise Exception("Interlock")
-            if scope["y"]:
-                self.hardware.write(lock["actuator"], lock["actuatorValue"])
-                self.db.set_setting("test_error", "Interlock")
-                raise Exception("Interlock")
-
-        return f
-
-    def stringify_tb(self, tb):
-        msg = "Traceback:\n\t"
-        msg += "\n\t".join(["%s:%s in %s" % (t.filename, t.lineno, t.name) for t in tb])
-        return msg
+            if self.samples is not None:
+                self.samples.finish()
+            self.spool.flush()
+            if self.graph_id is not None:
+                self.db.finish_test(self.graph_id, self.stats.summary())
+        self.stats.finish()
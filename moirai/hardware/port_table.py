@@ -0,0 +1,95 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+The ports of a hardware configuration, compiled once into records and NumPy
+arrays, so that loops don't have to go through the configuration's dicts.
+"""
+
+import numpy
+
+# Port types, as flags:
+# export enum Types {
+#     Digital = 1,
+#     Analog = 2,
+#     Input = 4,
+#     Output = 8,
+#     PWM = 16
+# }
+DIGITAL = 1
+ANALOG = 2
+INPUT = 4
+OUTPUT = 8
+PWM = 16
+
+
+class Port(object):
+    __slots__ = ("index", "id", "name", "alias", "type", "default")
+
+    def __init__(self, index, port):
+        self.index = index
+        self.id = port["id"]
+        self.name = port["name"]
+        self.alias = port["alias"]
+        self.type = int(port["type"])
+        self.default = float(port.get("defaultValue", None) or 0)
+
+    @property
+    def is_input(self):
+        return (self.type & INPUT) != 0
+
+    @property
+    def is_output(self):
+        return (self.type & (OUTPUT | PWM)) != 0
+
+    @property
+    def pwm(self):
+        return (self.type & PWM) != 0
+
+
+class PortTable(object):
+    """
+    Port records in configuration order, with their type flags and default
+    values in arrays indexed like them.
+    """
+
+    def __init__(self, ports):
+        self.ports = tuple(Port(i, p) for i, p in enumerate(ports))
+        self.types = numpy.array([p.type for p in self.ports], dtype=numpy.int32)
+        self.defaults = numpy.array([p.default for p in self.ports], dtype=float)
+        self.inputs = numpy.flatnonzero(self.types & INPUT)
+        self.outputs = numpy.flatnonzero(self.types & (OUTPUT | PWM))
+
+    def __len__(self):
+        return len(self.ports)
+
+    def __iter__(self):
+        return iter(self.ports)
+
+    def off_values(self):
+        """
+        @returns a dict of output alias: default value, the values outputs
+        are put back to when a run ends.
+        """
+        ports = self.ports
+        values = self.defaults.tolist()
+        return {ports[i].alias: values[i] for i in self.outputs}
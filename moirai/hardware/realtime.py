@@ -0,0 +1,195 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Opt-in real-time mode for the control loops, using Linux APIs only: the loop
+thread is pinned to CPUs and given SCHED_FIFO priority, the memory of the
+process is locked and the garbage collector only runs in the slack time
+before a deadline.
+"""
+
+import ctypes
+import ctypes.util
+import gc
+import os
+import threading
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# A collection of the youngest generation rarely takes more than this, so
+# it only runs if at least this much slack is left before the deadline.
+MIN_SLACK_NS = 1000000
+
+
+def _libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except (OSError, TypeError):
+        return None
+
+
+class ProcessState(object):
+    """
+    The memory lock and the garbage collector belong to the whole process,
+    which may run several real-time loops (PID and Free, say). The first
+    loop to enter applies them and the last one to leave restores them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.locked = False
+        self.gc_was_enabled = True
+
+    def acquire(self, applied):
+        with self.lock:
+            self.count += 1
+            if self.count == 1:
+                libc = _libc()
+                if libc is not None and hasattr(libc, "mlockall"):
+                    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+                        self.locked = True
+                    else:
+                        err = os.strerror(ctypes.get_errno())
+                        print("Real-time: could not lock memory: %s" % err)
+                self.gc_was_enabled = gc.isenabled()
+                gc.collect()
+                gc.freeze()
+                gc.disable()
+            if self.locked:
+                applied["mlockall"] = True
+            applied["gc"] = "slack"
+
+    def release(self):
+        with self.lock:
+            self.count -= 1
+            if self.count == 0:
+                self.restore()
+
+    def restore(self):
+        self.count = 0
+        if self.gc_was_enabled:
+            gc.enable()
+        gc.unfreeze()
+        if self.locked:
+            _libc().munlockall()
+            self.locked = False
+
+    def after_fork(self):
+        # The loops of the parent do not exist in the child, and memory locks
+        # are not inherited.
+        self.lock = threading.Lock()
+        self.locked = False
+        if self.count:
+            self.restore()
+
+
+process_state = ProcessState()
+os.register_at_fork(after_in_child=process_state.after_fork)
+
+
+class RealTime(object):
+    """
+    Applies the real-time settings of the hardware configuration to the
+    calling thread on enter(timer) and restores them on leave(). CPU affinity
+    and scheduler are per thread; the rest is shared through process_state.
+    Whatever is not permitted or not available is skipped; `applied` tells
+    what was done.
+
+        realtime?: boolean
+        realtimePriority?: number (SCHED_FIFO priority, 50 by default)
+        realtimeCpus?: number[]
+    """
+
+    def __init__(self, configuration):
+        configuration = configuration or {}
+        self.enabled = bool(configuration.get("realtime", False))
+        self.priority = int(configuration.get("realtimePriority", 50))
+        self.cpus = configuration.get("realtimeCpus", None)
+        self.applied = None
+        self.saved_affinity = None
+        self.saved_scheduler = None
+        self.timer = None
+        self.thresholds = gc.get_threshold()
+
+    def enter(self, timer=None):
+        if not self.enabled or self.applied is not None:
+            return
+        self.applied = {}
+        if self.cpus and hasattr(os, "sched_setaffinity"):
+            try:
+                self.saved_affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, self.cpus)
+                self.applied["cpus"] = sorted(self.cpus)
+            except OSError as err:
+                print("Real-time: could not set CPU affinity: %s" % err)
+        if hasattr(os, "sched_setscheduler"):
+            try:
+                scheduler = os.sched_getscheduler(0)
+                param = os.sched_getparam(0)
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+                self.saved_scheduler = (scheduler, param)
+                self.applied["priority"] = self.priority
+            except OSError as err:
+                print("Real-time: could not set SCHED_FIFO: %s" % err)
+        process_state.acquire(self.applied)
+        if timer is not None:
+            timer.idle = self.idle
+            self.timer = timer
+
+    def idle(self, slack_ns):
+        """
+        Called by the timer before sleeping, with the time left until the
+        deadline. Collects the generations that are due if there is time.
+        """
+        if slack_ns < MIN_SLACK_NS:
+            return
+        count0, count1, count2 = gc.get_count()
+        threshold0, threshold1, threshold2 = self.thresholds
+        if threshold0 and count0 >= threshold0:
+            if count1 >= threshold1 and slack_ns >= 4 * MIN_SLACK_NS:
+                gc.collect(2 if count2 >= threshold2 else 1)
+            else:
+                gc.collect(0)
+
+    def leave(self):
+        if self.applied is None:
+            return
+        if self.timer is not None:
+            self.timer.idle = None
+            self.timer = None
+        process_state.release()
+        if self.saved_scheduler is not None:
+            scheduler, param = self.saved_scheduler
+            try:
+                os.sched_setscheduler(0, scheduler, param)
+            except OSError:
+                pass
+            self.saved_scheduler = None
+        if self.saved_affinity is not None:
+            try:
+                os.sched_setaffinity(0, self.saved_affinity)
+            except OSError:
+                pass
+            self.saved_affinity = None
+        self.applied = None
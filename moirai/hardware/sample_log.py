@@ -0,0 +1,133 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+The layer through which every run mode logs its samples. Each channel has a
+logging policy, given by alias in the "logging" of the hardware configuration
+or of the run, the latter taking precedence:
+
+    "every": every sample (the default).
+    "change": only samples whose value changed.
+    {deadband?: number, minInterval?: number, maxInterval?: number}:
+        samples that moved more than deadband from the last one logged, no
+        more often than minInterval and at least every maxInterval seconds.
+
+When a sample is logged after others were dropped, the last dropped one is
+logged first, and so is the last one of each channel when the run ends. So a
+plateau is stored as its two ends, and readers reconstruct it as is.
+"""
+
+EVERY = "every"
+CHANGE = "change"
+
+
+class Policy(object):
+    __slots__ = ("deadband", "min_interval", "max_interval")
+
+    def __init__(self, policy):
+        if policy == CHANGE:
+            policy = {}
+        elif not isinstance(policy, dict):
+            raise ValueError("Unknown logging policy: %s" % policy)
+        self.deadband = float(policy.get("deadband", None) or 0)
+        self.min_interval = float(policy.get("minInterval", None) or 0)
+        self.max_interval = float(policy.get("maxInterval", None) or 0)
+
+
+class Channel(object):
+    __slots__ = ("policy", "value", "time", "held")
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.value = None
+        self.time = None
+        self.held = None
+
+
+def logging_policies(configuration, run=None, defaults=None):
+    """
+    @returns the logging policies by alias: `defaults`, overridden by those
+    of the hardware configuration, overridden by those of the run.
+    """
+    policies = dict(defaults or {})
+    policies.update((configuration or {}).get("logging", None) or {})
+    policies.update((run or {}).get("logging", None) or {})
+    return policies
+
+
+class SampleLog(object):
+    """
+    Saves the samples of the test `graph_id` through `spool`, applying the
+    logging policy of each channel.
+    """
+
+    def __init__(self, spool, graph_id, policies=None):
+        self.write = spool.save_test_sensor_value
+        self.graph_id = graph_id
+        self.channels = {}
+        for alias, policy in (policies or {}).items():
+            if policy != EVERY:
+                self.channels[alias] = Channel(Policy(policy))
+
+    def save(self, channel, value, time):
+        state = self.channels.get(channel, None)
+        if state is None:
+            self.write(self.graph_id, channel, value, time)
+            return
+        policy = state.policy
+        if state.time is None:
+            log = True
+        else:
+            elapsed = time - state.time
+            if elapsed < policy.min_interval:
+                log = False
+            elif policy.max_interval and elapsed >= policy.max_interval:
+                log = True
+            else:
+                log = moved(value, state.value, policy.deadband)
+        if not log:
+            state.held = (value, time)
+            return
+        if state.held is not None and value != state.value:
+            self.write(self.graph_id, channel, *state.held)
+        state.held = None
+        state.value = value
+        state.time = time
+        self.write(self.graph_id, channel, value, time)
+
+    def finish(self):
+        """
+        Logs the last sample of the channels where it was dropped.
+        """
+        for channel, state in self.channels.items():
+            if state.held is not None:
+                self.write(self.graph_id, channel, *state.held)
+                state.held = None
+
+
+def moved(value, last, deadband):
+    if not deadband:
+        return value != last
+    try:
+        return abs(value - last) > deadband
+    except TypeError:
+        return value != last
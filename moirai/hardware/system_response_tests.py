@@ -23,95 +23,105 @@
 import datetime
 
 from moirai.database import DatabaseV1
-from moirai.hardware.configured_hardware import ConfiguredHardware
+from moirai.database.spool import Spool
+from moirai.hardware.configured_hardware import Actuators, ConfiguredHardware, Snapshot
+from moirai.hardware.instrumentation import loop_stats
+from moirai.hardware.interlock import Interlock, InterlockEngine
+from moirai.hardware.sample_log import SampleLog, logging_policies
 from moirai.hardware.timer import Timer
 
 
 class SystemResponseTest(object):
     def __init__(self, test_id):
         self.db = DatabaseV1()
+        self.spool = Spool.instance()
         tests = self.db.get_setting("system_response_tests")
         self.test = next((t for t in tests if t["id"] == test_id), None)
         if self.test is None:
             raise Exception("Test not found")
-        self.hardware = ConfiguredHardware()
+        self.hardware = ConfiguredHardware.session()
         configuration = self.db.get_setting("hardware_configuration")
-        self.locks = list(map(self.interlock, configuration["interlock"]))
-        self.off_values = {
-            p["alias"]: float(p["defaultValue"])
-            for p in configuration["ports"]
-            if p["type"] & (8 | 16)
-        }
-
-    def interlock(self, lock):
-        code = compile("y=%s" % lock["expression"], "_string_", "exec")
-
-        def f(code=code, lock=lock):
-            value = self.hardware.read(lock["sensor"])
-            scope = {"x": value}
-            exec(code, None, scope)
-            if scope["y"]:
-                value = float(lock["actuatorValue"])
-                self.hardware.write(lock["actuator"], value)
-                self.db.set_setting("test_error", "Interlock")
-                raise Exception("Interlock")
-
-        return f
+        self.configuration = configuration
+        self.interlocks = InterlockEngine(
+            self.hardware, self.db, configuration, float(self.test["logRate"])
+        )
+        self.off_values = self.hardware.table.off_values()
 
     def run(self):
         self.db.set_setting("current_test", self.test["name"])
         self.db.set_setting("test_error", None)
 
-        for k, v in self.off_values.items():
-            self.hardware.write(k, v)
-
-        for o in self.test["fixedOutputs"]:
-            self.hardware.write(o["alias"], o["value"])
+        self.hardware.write_many(self.off_values)
+        fixed = {o["alias"]: o["value"] for o in self.test["fixedOutputs"]}
+        self.hardware.write_many(fixed)
 
         run_time = self.test["points"][-1]["x"]
         interval = self.test["logRate"]
-        t = Timer(run_time, interval)
+        t = Timer(run_time, interval, self.test.get("overrunPolicy", Timer.SKIP))
         ports = self.test["output"]  # Can be a list.
         ports = [ports] if isinstance(ports, str) else ports
         start_time = datetime.datetime.utcnow()
         last_port_value = 0
         t_elapsed = 0
-        graph_id = self.db.save_test(self.test["name"], start_time)
+        write_concern = self.test.get("writeConcern", None)
+        graph_id = self.db.save_test(self.test["name"], start_time, write_concern)
+        stats = loop_stats(self.db, self.test["name"], t)
+        defaults = {port: "change" for port in ports}
+        policies = logging_policies(self.configuration, self.test, defaults)
+        samples = SampleLog(self.spool, graph_id, policies)
+        stats.attach("interlock_evaluation", self.interlocks.latency)
+        stats.attach("interlock_reaction", self.interlocks)
+        self.interlocks.start(escalate=True)
+
+        snapshot = Snapshot(self.test["inputs"] + self.interlocks.sensors)
+        values = snapshot.values
+        actuators = Actuators(ports)
 
         try:
             while self.db.get_setting("current_test") is not None:
-                for lock in self.locks:
-                    lock()
+                if self.interlocks.tripped:
+                    break
+                self.hardware.acquire(snapshot)
+                t_elapsed = t.elapsed_at(snapshot.time)
+                stats.mark("read")
+
+                self.interlocks.check(values)
+                stats.mark("interlock")
 
                 for sensor in self.test["inputs"]:
-                    value = self.hardware.read(sensor)
-                    self.db.save_test_sensor_value(graph_id, sensor, value, t_elapsed)
+                    samples.save(sensor, values[sensor], t_elapsed)
+                stats.mark("log")
 
                 for point in self.test["points"]:
                     if t.elapsed() < point["x"]:
+                        actuators.values[:] = [point["y"]] * len(actuators.ports)
+                        self.hardware.actuate(actuators)
                         for port in ports:
-                            self.hardware.write(port, point["y"])
-                            self.db.save_test_sensor_value(
-                                graph_id, port, point["y"], t_elapsed
-                            )
+                            samples.save(port, point["y"], t_elapsed)
                         last_port_value = point["y"]
                         break
+                stats.mark("write")
 
                 t.sleep()
-                t_elapsed = t.elapsed()
+                stats.mark("sleep")
+                stats.tick()
 
+        except Interlock:
+            pass
         except Exception as e:
             print(e)
             self.db.set_setting("test_error", str(e))
 
-        for port in ports:
-            self.db.save_test_sensor_value(graph_id, port, last_port_value, t.elapsed())
+        self.interlocks.stop()
 
-        for o in self.test["afterOutputs"]:
-            self.hardware.write(o["alias"], o["value"])
+        for port in ports:
+            samples.save(port, last_port_value, t.elapsed())
 
-        for k, v in self.off_values.items():
-            self.hardware.write(k, v)
+        after = {o["alias"]: o["value"] for o in self.test["afterOutputs"]}
+        self.hardware.write_many(after)
+        self.hardware.write_many(self.off_values)
 
+        samples.finish()
+        self.spool.flush()
+        self.db.finish_test(graph_id, stats.summary())
         self.db.set_setting("current_test", None)
-        self.db.close()
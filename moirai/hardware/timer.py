@@ -20,6 +20,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
+import ctypes
+import ctypes.util
 import time
 
 
@@ -27,25 +30,151 @@ class Finished(Exception):
     pass
 
 
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_clock_nanosleep():
+    """
+    Returns libc's clock_nanosleep, or None where it's not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        f = libc.clock_nanosleep
+    except (OSError, AttributeError, TypeError):
+        return None
+    f.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(_Timespec),
+        ctypes.POINTER(_Timespec),
+    ]
+    f.restype = ctypes.c_int
+    return f
+
+
+_clock_nanosleep = _load_clock_nanosleep()
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+EINTR = 4
+
+
+def sleep_until(deadline):
+    """
+    Sleeps until the absolute deadline, in nanoseconds of time.monotonic_ns.
+    """
+    if _clock_nanosleep is not None:
+        ts = _Timespec(deadline // 1000000000, deadline % 1000000000)
+        while _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ts, None) == EINTR:
+            pass
+        return
+    remaining = deadline - time.monotonic_ns()
+    if remaining > 0:
+        time.sleep(remaining / 1e9)
+
+
 class Timer:
-    def __init__(self, seconds, interval):
+    """
+    Periodic scheduler on the monotonic clock. Ticks have absolute deadlines
+    (start + k * interval), so a late tick does not shift the following ones
+    and clock adjustments do not distort the period.
+
+    If a tick is reached after its deadline, policy decides what happens:
+        CATCH_UP: run the missed ticks back to back until back on schedule.
+        SKIP: drop the missed ticks and wait for the next one on schedule.
+        STRETCH: restart the schedule from now.
+
+    For short intervals the timer sleeps until `spin` seconds before the
+    deadline and busy-waits the rest, trading CPU for precision. By default
+    it spins for intervals shorter than 10ms.
+
+    If set, idle(slack_ns) is called before sleeping with the time left until
+    the deadline, to do housekeeping off the critical path.
+    """
+
+    CATCH_UP = "catchup"
+    SKIP = "skip"
+    STRETCH = "stretch"
+    POLICIES = (CATCH_UP, SKIP, STRETCH)
+
+    def __init__(self, seconds, interval, policy=SKIP, spin=None, history=1000):
+        if policy not in Timer.POLICIES:
+            raise ValueError("Unknown overrun policy: %s" % policy)
         self.seconds = seconds
+        self.policy = policy
+        self.spin = spin
         self.interval = interval
+        self.start_ns = time.monotonic_ns()
+        self.deadline = self.start_ns
         self.start = time.time()
-        self.t = time.time()
+        self.t = self.start
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.lateness = collections.deque(maxlen=history)
+        self.max_lateness = 0
+        self.idle = None
+
+    @property
+    def interval(self):
+        return self.interval_ns / 1e9
+
+    @interval.setter
+    def interval(self, interval):
+        self.interval_ns = max(int(interval * 1e9), 1)
+        if self.spin is not None:
+            self.spin_ns = int(self.spin * 1e9)
+        else:
+            self.spin_ns = 200000 if self.interval_ns < 10000000 else 0
 
     def sleep(self):
-        current_time = time.time()
-        if current_time - self.start > self.seconds:
+        now = time.monotonic_ns()
+        if now - self.start_ns > self.seconds * 1e9:
             raise Finished("Maximum time reached. Finished.")
-        nextTime = current_time + self.interval
-        nextTime -= nextTime % self.interval
+        self.deadline += self.interval_ns
+        if now > self.deadline:
+            self.overruns += 1
+            if self.overruns == 1:
+                print("Timer overrun. Interval too short?")
+            if self.policy == Timer.SKIP:
+                missed = (now - self.deadline) // self.interval_ns + 1
+                self.skipped += missed
+                self.deadline += missed * self.interval_ns
+            elif self.policy == Timer.STRETCH:
+                self.deadline = now
+        if self.idle is not None:
+            self.idle(self.deadline - self.spin_ns - now)
+        if self.spin_ns:
+            sleep_until(self.deadline - self.spin_ns)
+            while time.monotonic_ns() < self.deadline:
+                pass
+        else:
+            sleep_until(self.deadline)
         self.t = time.time()
-        dt = nextTime - self.t
-        if dt < 0:
-            dt = 0
-            print("Negative Δt in timer. Interval too short?")
-        time.sleep(dt)
+        late = time.monotonic_ns() - self.deadline
+        self.ticks += 1
+        self.lateness.append(late)
+        self.max_lateness = max(self.max_lateness, late)
 
     def elapsed(self):
-        return time.time() - self.start
+        return (time.monotonic_ns() - self.start_ns) / 1e9
+
+    def elapsed_at(self, ns):
+        """
+        Seconds from the start of the timer to `ns`, in time.monotonic_ns.
+        """
+        return (ns - self.start_ns) / 1e9
+
+    def stats(self):
+        """
+        Returns the lateness of the recent ticks and the overrun counters.
+        Times are in seconds.
+        """
+        lateness = list(self.lateness)
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "max_lateness": self.max_lateness / 1e9,
+            "mean_lateness": sum(lateness) / len(lateness) / 1e9 if lateness else 0,
+        }
@@ -0,0 +1,57 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Compiles the code of controllers into functions, so running it each tick
+costs a function call instead of an exec in a freshly built scope.
+"""
+
+import ast
+import math
+
+import numpy as np
+
+ARGUMENTS = "inputs, outputs, s, log, t, dt"
+
+
+def compile_function(source, filename):
+    """
+    Compiles `source` into a function of (inputs, outputs, s, log, t, dt)
+    that returns (s, outputs, log), as the code may rebind them. The
+    variables of the code become the function's locals and np and math its
+    globals, which are created once per compilation.
+
+    Raises SyntaxError, with the line numbers of `source`, exactly where
+    exec would.
+    """
+    module = ast.parse(source, filename, "exec")
+    compile(module, filename, "exec")  # Rejects what exec would, e.g. return
+
+    template = "def %s(%s):\n    return s, outputs, log\n" % (filename, ARGUMENTS)
+    function = ast.parse(template, filename).body[0]
+    function.body[:0] = module.body
+    module.body = [function]
+    ast.fix_missing_locations(module)
+
+    scope = {"np": np, "math": math}
+    exec(compile(module, filename, "exec"), scope)
+    return scope[filename]
@@ -56,7 +56,7 @@ from pathlib import Path
 
 import ahio
 from moirai import __version__, decorators
-from moirai.database import DatabaseV1
+from moirai.database import DatabaseV1, migrate
 from moirai.installer import install
 
 PROCESSES = {}
@@ -157,7 +157,8 @@ def start():
         print("\t--port=port Port for the web server.")
         print(
             "\t--db=[mysql|mongodb] [--username=root] [--password=1234] "
-            "[--host=127.0.0.1] Saves the dabatase configuration."
+            "[--host=127.0.0.1] [--archive-after=days] [--timeseries] "
+            "Saves the dabatase configuration."
         )
         print("")
         print("\tThe installer does not behave well with PyENV.")
@@ -178,6 +179,7 @@ def start():
                 hasher.update(bytes(pswd, "utf-8"))
                 pswd = hasher.hexdigest()
             print("Setting password to %s" % pswd)
+            migrate()
             database = DatabaseV1()
             database.set_setting("password", pswd)
             return
@@ -187,7 +189,7 @@ def start():
                 for k, v in (
                     arg.replace("--", "").split("=")
                     for arg in sys.argv
-                    if arg.startswith("--")
+                    if arg.startswith("--") and "=" in arg
                 )
             }
             opts = {
@@ -195,6 +197,8 @@ def start():
                 "username": opts.get("username", None),
                 "password": opts.get("password", None),
                 "host": opts.get("host", None),
+                "archive_after": opts.get("archive-after", None),
+                "timeseries": True if "--timeseries" in sys.argv else None,
             }
             opts = {k: v for k, v in opts.items() if v is not None}
             new_config = {"database": opts}
@@ -218,6 +222,11 @@ def start():
     print("Logging to %s" % decorators.log_file_path())
     print("Using ahio version %s" % ahio.__version__)
 
+    try:
+        migrate()
+    except Exception as error:
+        print("Could not migrate the database: %s" % error)
+
     # Creates a processs for each module of moirai
     for process in PS:
         spawn_process(process)
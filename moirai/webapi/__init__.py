@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import time
 from threading import Thread
 
 from moirai.abstract_process_handler import AbstractProcessHandler
@@ -47,6 +48,9 @@ class ProcessHandler(AbstractProcessHandler):
         super().__init__("WebAPI", pipe)
         self.api = APIv1(self, args)
         self.thread = Thread(target=self.api.run, name="WebAPIThread")
+        self.archiver = None
+        self.last_archive = 0
+        self.loop_stats = None
 
     def quit(self):
         self.api.stop()
@@ -54,10 +58,24 @@ class ProcessHandler(AbstractProcessHandler):
 
     def process_command(self, sender, cmd, args):
         """
-        Redirects the commands received to the CommandProcessor class.
+        Redirects the commands received to the CommandProcessor class. The
+        timing summaries of the hardware loops are only kept for the API, as
+        they arrive every second and would flood the log.
         """
-        if cmd:
+        if cmd == "loop_stats":
+            self.loop_stats = args
+        elif cmd:
             self.cmd_processor.process_command(sender, cmd, args)
 
     def loop(self):
-        pass
+        """
+        Moves old tests to the archive once an hour, without blocking IPC.
+        """
+        if time.time() - self.last_archive < 3600:
+            return
+        if self.archiver is not None and self.archiver.is_alive():
+            return
+        self.last_archive = time.time()
+        archive_tests = dont_raise(self.api.database.archive_tests)
+        self.archiver = Thread(target=archive_tests, name="ArchiveThread")
+        self.archiver.start()
@@ -29,7 +29,6 @@ import dateutil.parser
 import logging
 import os.path
 import tempfile
-import scipy.io as sio
 import sys
 from multiprocessing import Pipe
 
@@ -38,9 +37,10 @@ from enum import Enum
 
 from cheroot.wsgi import Server
 from cheroot.wsgi import PathInfoDispatcher
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from moirai.database import DatabaseV1
 from moirai.hardware import Hardware
+from moirai.webapi import export
 from moirai import __version__
 
 
@@ -123,6 +123,22 @@ class APIv1:
             view_func=self.live_graph_export_mat,
             methods=["POST"],
         )
+        self.app.add_url_rule(
+            "/live_graph/test/export/batch",
+            view_func=self.live_graph_export_batch,
+            methods=["POST"],
+        )
+        self.app.add_url_rule(
+            "/live_graph/test/loop_stats",
+            view_func=self.live_graph_loop_stats,
+            methods=["POST"],
+        )
+        self.app.add_url_rule(
+            "/loop_stats", view_func=self.loop_stats_get, methods=["GET"]
+        )
+        self.app.add_url_rule(
+            "/loop_stats", view_func=self.loop_stats_set, methods=["POST"]
+        )
         self.app.add_url_rule(
             "/controllers", view_func=self.controller_set, methods=["POST"]
         )
@@ -149,7 +165,16 @@ class APIv1:
             "/simulation/run", view_func=self.model_simulation_run, methods=["POST"]
         )
         self.app.add_url_rule("/pid/run", view_func=self.pid_run, methods=["POST"])
+        self.app.add_url_rule(
+            "/pid/update", view_func=self.pid_update, methods=["POST"]
+        )
+        self.app.add_url_rule("/pid/stop", view_func=self.pid_stop, methods=["GET"])
         self.app.add_url_rule("/free/run", view_func=self.free_run, methods=["POST"])
+        self.app.add_url_rule(
+            "/free/update", view_func=self.free_update, methods=["POST"]
+        )
+        self.app.add_url_rule("/free/renew", view_func=self.free_renew, methods=["GET"])
+        self.app.add_url_rule("/free/stop", view_func=self.free_stop, methods=["GET"])
 
         d = PathInfoDispatcher({"/": self.app})
         port = [x for x in self.args if x.startswith("--port")] + ["--port=5000"]
@@ -318,11 +343,60 @@ class APIv1:
                 {
                     port: number,
                     alias: string,
-                    formula: string
+                    formula?: string,
+                    table?: {x: number[], y: number[]}
                 }
-            ]
+            ],
+            interlockRate?: number,
+            interlockPriority?: number,
+            interlockCpus?: number[],
+            interlockTimeout?: number,
+            readWorkers?: number,
+            threadSafe?: boolean,
+            experimentCpus?: number[],
+            realtime?: boolean,
+            realtimePriority?: number,
+            realtimeCpus?: number[],
+            logging?: {[alias: string]: "every" | "change" | {...}}
         }
 
+        A calibration has either a formula of x or a table of raw values x
+        and their calibrated values y, which is interpolated linearly (and
+        inverted for outputs).
+
+        The interlocks are checked by a watchdog process interlockRate times a
+        second (once per tick if not given), with SCHED_FIFO priority
+        interlockPriority where permitted and pinned to interlockCpus if
+        given. It uses the values read by the running loop, which are read
+        by a thread of their own when the loop falls behind. Without values
+        for interlockTimeout seconds (ten periods, at least one second, by
+        default), it trips as a failsafe for every interlocked actuator. The
+        safe values are written by the process running the loop. For
+        controllers and system response tests, if they aren't written
+        interlockTimeout seconds after a trip, the watchdog kills that
+        process and the hardware process sets the outputs to their defaults
+        and the interlocked actuators to their safe values. PID and Free
+        runs have no such backstop.
+
+        With readWorkers greater than 1 and threadSafe true (or a driver that
+        declares itself thread safe), ports are read in parallel by that many
+        threads sharing the driver. Otherwise they are read one at a time.
+
+        logging sets how the samples of each channel are logged: "every"
+        sample (the default), on "change", or {deadband?: number,
+        minInterval?: number, maxInterval?: number}, logging samples that
+        moved more than deadband, no more often than minInterval and at
+        least every maxInterval seconds. Tests, controllers, PID and Free
+        runs can override it with a logging of their own. The ends of each
+        plateau are kept, so dropped samples are held at the last value.
+
+        Controllers and tests run in a process of their own, pinned to
+        experimentCpus if given.
+
+        With realtime, the running loop is pinned to realtimeCpus, given
+        SCHED_FIFO priority realtimePriority (where permitted), its memory is
+        locked and the garbage collector only runs between ticks.
+
         @returns:
             On success, HTTP 200 Ok and body:
 
@@ -367,9 +441,21 @@ class APIv1:
                     {
                         port: number,
                         alias: string,
-                        formula: string
+                        formula?: string,
+                        table?: {x: number[], y: number[]}
                     }
-                ]
+                ],
+                interlockRate?: number,
+                interlockPriority?: number,
+                interlockCpus?: number[],
+                interlockTimeout?: number,
+                readWorkers?: number,
+                threadSafe?: boolean,
+                experimentCpus?: number[],
+                realtime?: boolean,
+                realtimePriority?: number,
+                realtimeCpus?: number[],
+                logging?: {[alias: string]: "every" | "change" | {...}}
             }
 
             or
@@ -408,6 +494,9 @@ class APIv1:
                     value: number
                 }]
                 logRate: number
+                writeConcern?: {w: number, j: boolean}
+                overrunPolicy?: "catchup" | "skip" | "stretch"
+                logging?: {[alias: string]: "every" | "change" | {...}}
             }]
 
             or
@@ -444,6 +533,8 @@ class APIv1:
                 value: number
             }]
             logRate: number
+            writeConcern?: {w: number, j: boolean}
+            overrunPolicy?: "catchup" | "skip" | "stretch"
         }]
 
         @returns:
@@ -618,14 +709,23 @@ class APIv1:
 
     def live_graph_export_mat(self):
         """
-        Generates a MATLAB's MAT file from data. It must be a POST request with
-        following body:
+        Exports the data of a test. It must be a POST request with following
+        body:
 
         {
             test: string
             start_time: string (ISO 8601)
+            variables: {[sensor: string]: string}
+            calibrate?: {[sensor: string]: string}
+            format?: "mat" | "mat73" | "parquet" | "csv"
         }
 
+        The format defaults to "mat" (MAT v5). The samples are streamed from
+        the database and aligned onto the union of the time bases of all
+        variables, each one holding its last value (NaN before its first
+        sample). calibrate maps sensors logged as raw values to the alias of
+        the calibration, in the hardware configuration, to convert them with.
+
         @returns:
             On success, HTTP 200 Ok and body:
 
@@ -634,6 +734,15 @@ class APIv1:
             On failure, HTTP 403 Unauthorized and body:
 
             {}
+
+            If the format is unknown, HTTP 400 Bad Request and body:
+
+            {}
+
+            If the format requires a library that is not installed,
+            HTTP 501 Not Implemented and body:
+
+            {error: string}
         """
         if not self.verify_token():
             return "{}", 403
@@ -641,27 +750,182 @@ class APIv1:
         test = request.json["test"]
         start_time = dateutil.parser.parse(request.json["start_time"])
         v = request.json["variables"]
+        fmt = request.json.get("format", "mat")
+        calibrations = self.__calibrations(request.json.get("calibrate", None))
 
-        ks = list(v.keys())
-        ds = self.database.get_filtered_test_data(test, start_time, ks)
-        ts = ds[0]["time"]
-        ds = {v.get(d["sensor"], d["sensor"]): d["values"] for d in ds}
-        ds["t"] = ts
+        if fmt not in export.WRITERS:
+            return "{}", 400
 
-        directory = tempfile.gettempdir()
-        file_path = os.path.join(directory, "test.mat")
-
-        sio.savemat(file_path, ds)
-
-        f = open(file_path, "rb")
+        f = tempfile.TemporaryFile()
+        try:
+            export.export_test(self.database, test, start_time, v, fmt, f, calibrations)
+        except ImportError as e:
+            f.close()
+            return json.dumps({"error": str(e)}), 501
+        f.seek(0)
 
         return send_file(
             f,
             as_attachment=True,
-            download_name="data.mat",
+            download_name="data." + export.WRITERS[fmt].extension,
             mimetype="application/octet-stream",
         )
 
+    def live_graph_export_batch(self):
+        """
+        Exports the data of several tests as a single zip, with one file per
+        test. It must be a POST request with following body:
+
+        {
+            tests: [{
+                test: string
+                start_time: string (ISO 8601)
+                variables: {[sensor: string]: string}
+                calibrate?: {[sensor: string]: string}
+            }]
+            format?: "mat" | "mat73" | "parquet" | "csv"
+        }
+
+        Each test is exported as in /live_graph/test/export.
+
+        The tests are exported in parallel and the zip is streamed as each
+        one finishes. Tests that could not be exported are listed, with the
+        error, in errors.json inside the zip.
+
+        @returns:
+            On success, HTTP 200 Ok and body:
+
+            file-contents
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+
+            If the format is unknown, HTTP 400 Bad Request and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        fmt = request.json.get("format", "mat")
+        if fmt not in export.WRITERS:
+            return "{}", 400
+
+        tests = [
+            {
+                "test": t["test"],
+                "start_time": dateutil.parser.parse(t["start_time"]),
+                "variables": t["variables"],
+                "calibrations": self.__calibrations(t.get("calibrate", None)),
+            }
+            for t in request.json["tests"]
+        ]
+
+        return Response(
+            export.export_batch(self.database, tests, fmt),
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=export.zip"},
+        )
+
+    def live_graph_loop_stats(self):
+        """
+        Returns the timing summary stored with a test, if it was run with
+        loop instrumentation enabled. It must be a POST request with following
+        body:
+
+        {
+            test: string
+            start_time: string (ISO 8601)
+        }
+
+        @returns:
+            On success, HTTP 200 Ok and body:
+
+            {
+                name: string
+                buckets: number[]
+                misses: number
+                lateness: histogram
+                phases: {[phase: string]: histogram}
+            } | null
+
+            where histogram is
+
+            {
+                count: number
+                mean: number
+                max: number
+                counts: number[]
+            }
+
+            Times are in microseconds. counts has one more element than
+            buckets, for the samples above the last bucket.
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        test = request.json["test"]
+        start_time = dateutil.parser.parse(request.json["start_time"])
+        stats = self.database.get_test_loop_stats(test, start_time)
+
+        return json.dumps(stats)
+
+    def loop_stats_get(self):
+        """
+        Returns the timing summary of the running loop, updated every second
+        while a test runs with loop instrumentation enabled. It must be a GET
+        request.
+
+        @returns:
+            On success, HTTP 200 Ok and body:
+
+            {
+                enabled: boolean
+                stats: same as /live_graph/test/loop_stats
+            }
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        enabled = bool(self.database.get_setting("loop_instrumentation"))
+        return json.dumps({"enabled": enabled, "stats": self.ph.loop_stats})
+
+    def loop_stats_set(self):
+        """
+        Enables or disables loop instrumentation for the tests started from
+        now on. It must be a POST request with following body:
+
+        {
+            enabled: boolean
+        }
+
+        @returns:
+            On success, HTTP 200 Ok and body:
+
+            {}
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        enabled = bool(request.json["enabled"])
+        self.database.set_setting("loop_instrumentation", enabled)
+        self.ph.loop_stats = None
+
+        return "{}"
+
     def controller_set(self):
         """
         Saves a controller. It must be a POST request with following body:
@@ -675,6 +939,8 @@ class APIv1:
             controller: string
             after: string
             inputs: string[]
+            writeConcern?: {w: number, j: boolean}
+            overrunPolicy?: "catchup" | "skip" | "stretch"
         }]
 
         @returns:
@@ -709,6 +975,9 @@ class APIv1:
                 controller: string
                 after: string
                 inputs: string[]
+                writeConcern?: {w: number, j: boolean}
+                overrunPolicy?: "catchup" | "skip" | "stretch"
+                logging?: {[alias: string]: "every" | "change" | {...}}
             }]
 
             On failure, HTTP 403 Unauthorized and body:
@@ -908,6 +1177,17 @@ class APIv1:
                 db.restore_database_v2(d["settings"], d["graphs"])
         return "{}"
 
+    def __calibrations(self, calibrate):
+        """
+        Maps the sensors in `calibrate` to the calibrations, from the hardware
+        configuration, named by their values.
+        """
+        if not calibrate:
+            return None
+        config = self.database.get_setting("hardware_configuration") or {}
+        cs = {c["alias"]: c for c in config.get("calibrations", [])}
+        return {s: cs[alias] for s, alias in calibrate.items() if alias in cs}
+
     def __ports_for_driver(self, driver):
         """
         Returns a list of encoded ports for the given driver.
@@ -993,8 +1273,17 @@ class APIv1:
                             alias: string
                             value: number
                           }[]
+            writeConcern?: {w: number, j: boolean}
+            overrunPolicy?: "catchup" | "skip" | "stretch"
+            logging?: {[alias: string]: "every" | "change" | {...}}
+            lease?: number
         }
 
+        The controller runs for `lease` seconds (twice dt, and at least one,
+        if not given) after the last request. If it's already running for the
+        same y and u, the request only renews the lease and updates the
+        parameters, like /pid/update.
+
         @returns: On success, HTTP 200 Ok and body:
 
             {}
@@ -1010,6 +1299,56 @@ class APIv1:
         self.ph.send_command("hardware", "run_pid", args)
         return "{}"
 
+    def pid_update(self):
+        """
+        Renews the lease of the running PID controller and updates any of its
+        parameters, which are applied together between two ticks. It must be
+        a POST request with the following body:
+
+        {
+            Kp?: number
+            Ki?: number
+            Kd?: number
+            r?: number
+            umax?: number
+            umin?: number
+            dt?: number
+            lease?: number
+        }
+
+        @returns: On success, HTTP 200 Ok and body:
+
+            {}
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        args = request.json or {}
+        self.ph.send_command("hardware", "update_pid", args)
+        return "{}"
+
+    def pid_stop(self):
+        """
+        Stops the PID controller. It must be a GET request.
+
+        @returns: On success, HTTP 200 Ok and body:
+
+            {}
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        self.ph.send_command("hardware", "stop_pid", None)
+        return "{}"
+
     def free_run(self):
         """
         Controls the plant outputs freely.
@@ -1021,8 +1360,17 @@ class APIv1:
                         alias: string
                         value: number
                      }[]
+            writeConcern?: {w: number, j: boolean}
+            overrunPolicy?: "catchup" | "skip" | "stretch"
+            logging?: {[alias: string]: "every" | "change" | {...}}
+            lease?: number
         }
 
+        Starts a session, which runs for `lease` seconds (twice dt, and at
+        least one, if not given) after the last request. If one is already
+        running with the same inputs, the request renews its lease and only
+        the outputs whose value changed are written.
+
         @returns: On success, HTTP 200 Ok and body:
 
             {}
@@ -1037,3 +1385,70 @@ class APIv1:
         args = request.json
         self.ph.send_command("hardware", "run_free", args)
         return "{}"
+
+    def free_update(self):
+        """
+        Renews the lease of the running Free session and sets the given
+        outputs, leaving the others as they are. It must be a POST request
+        with the following body:
+
+        {
+            outputs?: {
+                        alias: string
+                        value: number
+                      }[]
+            lease?: number
+        }
+
+        @returns: On success, HTTP 200 Ok and body:
+
+            {}
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        args = request.json or {}
+        self.ph.send_command("hardware", "update_free", args)
+        return "{}"
+
+    def free_renew(self):
+        """
+        Renews the lease of the running Free session. It must be a GET
+        request, with an optional `lease` query parameter in seconds.
+
+        @returns: On success, HTTP 200 Ok and body:
+
+            {}
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        lease = request.args.get("lease", None)
+        self.ph.send_command("hardware", "renew_free", {"lease": lease})
+        return "{}"
+
+    def free_stop(self):
+        """
+        Stops the running Free session. It must be a GET request.
+
+        @returns: On success, HTTP 200 Ok and body:
+
+            {}
+
+            On failure, HTTP 403 Unauthorized and body:
+
+            {}
+        """
+        if not self.verify_token():
+            return "{}", 403
+
+        self.ph.send_command("hardware", "stop_free", None)
+        return "{}"
@@ -0,0 +1,336 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Streaming export of tests. Samples are read from the database in chunks,
+aligned onto a common time base and appended to the output file, so the
+memory used does not depend on the length of the test.
+"""
+
+import json
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import scipy.io as sio
+
+from moirai.hardware.calibration import calibrate_series
+
+
+class Aligner(object):
+    """
+    Aligns chunks of samples onto a common time base, the union of the
+    timestamps of all channels. Each channel holds its last value until its
+    next sample (a backward merge-asof) and is NaN before its first one.
+    """
+
+    def __init__(self, sensors):
+        self.sensors = list(sensors)
+        self.last = np.full(len(self.sensors), np.nan)
+        self.pending = (np.empty(0, dtype=object), np.empty(0), np.empty(0))
+
+    def align(self, chunk):
+        """
+        Aligns a (sensors, times, values) chunk sorted by time. Samples at the
+        last instant of the chunk are held back until the next call, as the
+        rest of that instant may come in the next chunk.
+
+        @returns (t, values), with one column in values per sensor.
+        """
+        names, times, values = chunk
+        names = np.concatenate((self.pending[0], np.asarray(names, dtype=object)))
+        times = np.concatenate((self.pending[1], np.asarray(times, dtype=float)))
+        values = np.concatenate((self.pending[2], np.asarray(values, dtype=float)))
+        if len(times) == 0:
+            return self.__align(names, times, values)
+        cut = np.searchsorted(times, times[-1], side="left")
+        self.pending = names[cut:], times[cut:], values[cut:]
+        return self.__align(names[:cut], times[:cut], values[:cut])
+
+    def flush(self):
+        """
+        Aligns the samples held back by the last call to align.
+        """
+        names, times, values = self.pending
+        self.pending = (np.empty(0, dtype=object), np.empty(0), np.empty(0))
+        return self.__align(names, times, values)
+
+    def __align(self, names, times, values):
+        t = np.unique(times)
+        aligned = np.empty((len(t), len(self.sensors)))
+        for i, sensor in enumerate(self.sensors):
+            mask = names == sensor
+            ts, vs = times[mask], values[mask]
+            if len(vs) == 0:
+                aligned[:, i] = self.last[i]
+                continue
+            pos = np.searchsorted(ts, t, side="right") - 1
+            aligned[:, i] = np.where(pos >= 0, vs[np.maximum(pos, 0)], self.last[i])
+            self.last[i] = vs[-1]
+        return t, aligned
+
+
+class MatWriter(object):
+    """
+    MATLAB's MAT v5 file. scipy can't append to it, so the columns are kept in
+    memory and written when the writer is closed.
+    """
+
+    extension = "mat"
+
+    def __init__(self, f, names):
+        self.f = f
+        self.names = names
+        self.t = []
+        self.values = []
+
+    def write(self, t, values):
+        self.t.append(t)
+        self.values.append(values)
+
+    def close(self):
+        t = np.concatenate(self.t) if self.t else np.empty(0)
+        values = np.concatenate(self.values) if self.values else np.empty((0, 0))
+        data = {name: values[:, i] for i, name in enumerate(self.names)}
+        data["t"] = t
+        sio.savemat(self.f, data)
+
+
+class Mat73Writer(object):
+    """
+    MATLAB's MAT v7.3 file, which is an HDF5 file with a 512 bytes header.
+    MATLAB is column-major, so a column of N samples is a (1, N) dataset.
+    """
+
+    extension = "mat"
+
+    def __init__(self, f, names):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("Exporting to MAT v7.3 requires h5py")
+        self.f = f
+        self.h5 = h5py.File(f, "w", userblock_size=512)
+        self.datasets = []
+        for name in ["t"] + names:
+            ds = self.h5.create_dataset(
+                name,
+                shape=(1, 0),
+                maxshape=(1, None),
+                chunks=(1, 65536),
+                dtype="f8",
+                compression="gzip",
+            )
+            ds.attrs["MATLAB_class"] = np.bytes_("double")
+            self.datasets.append(ds)
+        self.size = 0
+
+    def write(self, t, values):
+        size = self.size + len(t)
+        for i, ds in enumerate(self.datasets):
+            ds.resize((1, size))
+            ds[0, self.size : size] = t if i == 0 else values[:, i - 1]
+        self.size = size
+
+    def close(self):
+        self.h5.close()
+        created = time.strftime("%a %b %d %H:%M:%S %Y")
+        text = "MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: %s " % created
+        text += "HDF5 schema 1.00 ."
+        header = text.encode("ascii").ljust(116) + b" " * 8 + b"\x00\x02IM"
+        self.f.seek(0)
+        self.f.write(header.ljust(512, b"\x00"))
+
+
+class ParquetWriter(object):
+    """
+    Apache Parquet file, one row group per chunk.
+    """
+
+    extension = "parquet"
+
+    def __init__(self, f, names):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Exporting to Parquet requires pyarrow")
+        self.pyarrow = pyarrow
+        self.names = ["t"] + names
+        schema = pyarrow.schema([(name, pyarrow.float64()) for name in self.names])
+        self.writer = pyarrow.parquet.ParquetWriter(f, schema)
+
+    def write(self, t, values):
+        columns = [t] + [values[:, i] for i in range(values.shape[1])]
+        table = self.pyarrow.Table.from_arrays(columns, names=self.names)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvWriter(object):
+    """
+    Comma-separated values, with a header line.
+    """
+
+    extension = "csv"
+
+    def __init__(self, f, names):
+        self.f = f
+        f.write((",".join(["t"] + names) + "\n").encode("utf-8"))
+
+    def write(self, t, values):
+        rows = np.column_stack((t, values))
+        np.savetxt(self.f, rows, fmt="%.17g", delimiter=",", encoding="utf-8")
+
+    def close(self):
+        pass
+
+
+WRITERS = {
+    "mat": MatWriter,
+    "mat73": Mat73Writer,
+    "parquet": ParquetWriter,
+    "csv": CsvWriter,
+}
+
+
+def export_test(db, test, start_time, variables, fmt, f, calibrations=None):
+    """
+    Writes the samples of a test to the binary file `f`, in format `fmt` (one
+    of WRITERS). `variables` maps each sensor to export to its name in the
+    file. `calibrations` maps sensors whose stored values are raw to the
+    calibration converting them.
+    """
+    sensors = list(variables)
+    names = [variables[sensor] or sensor for sensor in sensors]
+    calibrations = [
+        (i, calibrations[sensor])
+        for i, sensor in enumerate(sensors)
+        if calibrations and sensor in calibrations
+    ]
+    writer = WRITERS[fmt](f, names)
+    aligner = Aligner(sensors)
+
+    def write(t, values):
+        if len(t) == 0:
+            return
+        for i, calibration in calibrations:
+            values[:, i] = calibrate_series(calibration, values[:, i])
+        writer.write(t, values)
+
+    for chunk in db.iter_test_data(test, start_time, sensors):
+        write(*aligner.align(chunk))
+    write(*aligner.flush())
+    writer.close()
+
+
+class ZipStream(object):
+    """
+    Write-only file that keeps what is written to it until taken. zipfile
+    writes data descriptors when its file can't seek, so the archive can be
+    sent while it's being written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_batch(db, tests, fmt, workers=4):
+    """
+    Exports several tests to a single zip, generated as it's sent. Each item
+    of `tests` is a dict with test, start_time, variables and, optionally,
+    calibrations, as accepted by export_test. Tests are exported in parallel
+    into temporary files and added to the zip as they finish, so the order of
+    the files is not the order of `tests`. Tests that fail are listed in
+    errors.json.
+    """
+
+    def run(item):
+        f = tempfile.TemporaryFile()
+        try:
+            export_test(
+                db,
+                item["test"],
+                item["start_time"],
+                item["variables"],
+                fmt,
+                f,
+                item.get("calibrations", None),
+            )
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    stream = ZipStream()
+    zip_file = zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED)
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, item): i for i, item in enumerate(tests)}
+        for future in as_completed(futures):
+            i = futures[future]
+            name = re.sub(r"[^\w.-]+", "_", tests[i]["test"]).strip("_")
+            name = "%03d-%s.%s" % (i + 1, name, WRITERS[fmt].extension)
+            try:
+                f = future.result()
+            except Exception as e:
+                errors.append({"test": tests[i]["test"], "error": str(e)})
+                continue
+            with f:
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = f.seek(0, 2)
+                f.seek(0)
+                with zip_file.open(info, "w") as entry:
+                    while True:
+                        data = f.read(1 << 20)
+                        if not data:
+                            break
+                        entry.write(data)
+                        yield stream.take()
+            yield stream.take()
+    if errors:
+        zip_file.writestr("errors.json", json.dumps(errors))
+    zip_file.close()
+    yield stream.take()